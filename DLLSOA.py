@@ -3,27 +3,46 @@ import torch.utils.data as data
 from torch.optim import Adam
 import numpy as np
 import torch as t
-from utils import (calculate_grad_norm,
+from utils import (calculate_norms,
                    get_weight_num,
-                   calculate_weight_norm,
+                   get_component_keys,
+                   fold_conv_bn,
                    compute_power_coeff,
                    compute_alpha,
-                   aggregation,
                    weight_init,
                    init_w,
                    calculate_E,
                    gen_topo,
-                   create_folder,
-                   calculate_agg_var,
-                   calculate_data_amount)
+                   create_folder)
 import random
 from tensorboardX import SummaryWriter
 from copy import deepcopy
 from dataset import load_mnist, load_cifar10
-from model import resnet18
+from model import resnet18, CNN
+from channel import (calculate_E_batch,
+                     compute_power_coeff_batch,
+                     compute_alpha_batch,
+                     compute_alpha_neighbors,
+                     calculate_agg_var_batch,
+                     calculate_agg_var_graph,
+                     OTAAccumulator)
+from topology import Graph, generate_graph, TopologySchedule
+from engine import FlatParamEngine, FlatAdam, VmapTrainer
+from parallel import ClientPool
+from codec import PayloadCodec
+from profiler import RoundProfiler
+from runner import ModelRunner, execution_report
+from checkpoint import (capture_state,
+                        restore_state,
+                        restore_clients,
+                        restore_torch_rng,
+                        load_checkpoint,
+                        CheckpointWriter)
 import random
 from numpy import ndarray
 import time
+import heapq
+import json
 import os
 import yaml
 from tqdm import tqdm
@@ -43,7 +62,10 @@ class LocalClient(object):
                  device: t.device,
                  channel_gain: ndarray,
                  pow_limit: bool,
-                 pow_allow_stg: str):
+                 pow_allow_stg: str,
+                 sparse_ratio: float = 0.01,
+                 transmit_buffers: bool = False,
+                 fold_bn: bool = False):
         # save parameters as member variables
         self.id = id
         self.model = local_model.to(device)
@@ -62,8 +84,47 @@ class LocalClient(object):
         self.model.apply(weight_init)
         # init channel gain
         self.channel_gain = channel_gain
+        # the name -> parameter (or buffer) index of the model, it refers to the live tensors
+        self.components = self.model.state_dict(keep_vars=True)
+        self.positions = {key: idx for idx,
+                          key in enumerate(self.components.keys())}
+        # the components which can be chosen by the mask, the running statistics of
+        # BatchNorm are included if transmit_buffers
+        self.transmit_buffers = transmit_buffers
+        self.component_keys = get_component_keys(self.model, transmit_buffers)
+        # evaluate the model with the BatchNorm layers folded into the convolutions,
+        # the folded copy is cached with the version of the parameters
+        self.fold_bn = fold_bn
+        self.folded = None
+        # the norms of the components, they are valid until the parameters change
+        self.version = 0
+        self.norm_cache = {}
+        # the element-wise sparsification keeps a reference copy of the parameters which the
+        # neighbors also know, the residual x - reference is the error-feedback memory.
+        # the initial models are assumed to be known by the neighbors, e.g. from a shared seed.
+        # Only the receivers of the last payload know the later reference copies, None means
+        # every client, the others get the whole reference copy again
+        self.sparse_ratio = sparse_ratio
+        self.reference = None
+        self.reference_holders = None
+        self.receivers = set()
+        self.payload = None
+        self.payload_norms = {}
+        if self.comp_strategy in ("topk", "randk"):
+            self.reference = self.flat_params().clone()
+        # the payload codec, the encoded components are cached until the parameters change,
+        # sent keeps the last decoded value of every component for the delta encoding
+        self.codec = None
+        self.encoded = {}
+        self.sent = {}
+        # the receivers of the latest payload of every component, they know sent, and the
+        # receivers which know the base of the current payload
+        self.holders = {}
+        self.base_holders = {}
+        # the runner of the cpu execution options, None means the plain forward pass
+        self.runner = None
 
-    def rcv_params(self, model_params: dict, xi_neighbors: ndarray, weight_neighbors: ndarray, amendment_strategy: str):
+    def rcv_params(self, model_params: dict, xi_neighbors: ndarray, weight_neighbors: ndarray, amendment_strategy: str, alpha: float = None, self_weight: float = None):
         """
         receive the parameters from the neighbors
         ------
@@ -71,27 +132,33 @@ class LocalClient(object):
             model_params:dict, the sum of neighboring clients information through over-the-air aggregation (already added noise)
             xi_neighbors: the xi of the neighbors
             weight_neighbors: the weight of the neighbors
+            alpha: the precomputed alpha, if None, compute it according to the amendment_strategy
+            self_weight: the W_ii of the client, if None, use weight_neighbors[self.id]
         Returns:
             None
         """
         # compute alpha
-        if amendment_strategy == "eq5":
+        if amendment_strategy not in ("eq5", "eq6"):
+            raise ValueError("Unsupported value, only support eq5 and eq6")
+        if alpha is None and amendment_strategy == "eq5":
             alpha = compute_alpha(self.id, xi_neighbors.copy(),
                                   None, self.pow_limit)
-        elif amendment_strategy == "eq6":
+        elif alpha is None and amendment_strategy == "eq6":
             alpha = compute_alpha(self.id, xi_neighbors.copy(),
                                   weight_neighbors.copy(), self.pow_limit)
-        else:
-            raise ValueError("Unsupported value, only support eq5 and eq6")
 
+        if self_weight is None:
+            self_weight = weight_neighbors[self.id]
         if model_params is not None:
-            # begin aggregation
-            model_params = {k: v*alpha for k, v in model_params.items()}
-            # add its' own parameters
-            model_params = {
-                k: model_params[k]+self.model.state_dict()[k]*weight_neighbors[self.id] for k in model_params.keys()}
-            # finally load the state dictionary
-            self.model.load_state_dict(model_params, strict=False)
+            # update the components in place: w = w*W_ii + alpha*received
+            with t.no_grad():
+                for k, v in model_params.items():
+                    self.components[k].mul_(
+                        float(self_weight)).add_(v, alpha=float(alpha))
+                    # the noise of the channel may turn a variance negative
+                    if k.endswith("running_var"):
+                        self.components[k].clamp_(min=0.)
+            self.invalidate_norms()
 
     def send_params(self, component_keys: list[str], W: float, channel_gain: ndarray, beta: float, beta_noise: float):
         """
@@ -112,24 +179,171 @@ class LocalClient(object):
         #
         with t.no_grad():
             # compute the power allocation coefficients b_ij^t(k) first
-            weight_norm = calculate_weight_norm(self.model, component_keys)
+            weight_norm = self.weight_norm(component_keys)
             weight_norm_val = np.array(list(weight_norm.values()))
             # compute E
             beta = np.random.normal(0.0, beta_noise)+beta
             E = calculate_E(W, weight_norm_val, channel_gain, beta)
             b, xi = compute_power_coeff(
                 E, W, channel_gain, weight_norm_val, self.pow_limit, self.pow_allow_stg)
-            # get the parameters according to the mask (here we use key to read the parameters)
-            all_keys = self.model.state_dict().keys()
-            model_param = {}
-            for key in all_keys:
-                if key in component_keys:
-                    model_param[key] = self.model.state_dict()[key]
-            # multiply the weight by the power allocation coefficients and the channel gain
-            for idx, key in enumerate(component_keys):
-                model_param[key] = model_param[key]*b[idx]*channel_gain[idx]
             # finally, return the processed parameters
-            return model_param, xi
+            return self.transmit(component_keys, b, channel_gain), xi
+
+    def transmit(self, component_keys: list[str], b: ndarray, channel_gain: ndarray):
+        """
+        get the parameters according to the mask and the precomputed power allocation coefficients
+        ------
+        Parameters:
+            component_keys: the key of parameters, i.e. the mask in the paper
+            b: the power allocation coefficients of the components
+            channel_gain: the channel gain of the specified local device
+        Returns:
+            model_param:the specified parameters after power coefficient adjustments
+        """
+        # the power allocation coefficient and the channel gain of each component
+        scale = {key: b[idx]*channel_gain[idx]
+                 for idx, key in enumerate(component_keys)}
+        model_param = {}
+        with t.no_grad():
+            # keep the order of the state dict, the payload is the only new tensor
+            for key in sorted(scale.keys(), key=self.positions.__getitem__):
+                model_param[key] = self.components[key]*float(scale[key])
+        return model_param
+
+    def transmit_into(self, accumulator: OTAAccumulator, component_keys: list[str], b: ndarray, channel_gain: ndarray, receiver: int = None):
+        """
+        add the parameters according to the mask and the precomputed power allocation
+        coefficients directly into the receive buffers of the receiver
+        ------
+        Parameters:
+            accumulator: the receive buffers of the receiver
+            component_keys: the key of parameters, i.e. the mask in the paper
+            b: the power allocation coefficients of the components
+            channel_gain: the channel gain of the specified local device
+            receiver: the id of the receiver, the delta encoding resends the base to the
+                receivers which have missed the last payload
+        Returns:
+            None
+        """
+        scale = {key: b[idx]*channel_gain[idx]
+                 for idx, key in enumerate(component_keys)}
+        for key in sorted(scale.keys(), key=self.positions.__getitem__):
+            if self.codec is None:
+                accumulator.add(key, self.components[key], float(scale[key]))
+                continue
+            payload = self.encode(key)
+            resend_base = payload[2] is not None and receiver not in self.base_holders[key]
+            accumulator.add_encoded(key, payload, float(
+                scale[key]), self.codec, resend_base)
+            if self.codec.delta:
+                self.holders[key].add(receiver)
+
+    def encode(self, key: str):
+        """
+        encode a component with the payload codec, the payload is shared by all receivers
+        until the parameters change
+        ------
+        Parameters:
+            key: the name of the component
+        Returns:
+            the payload, see codec.PayloadCodec
+        """
+        if key in self.encoded and self.encoded[key][0] == self.version:
+            return self.encoded[key][1]
+        with t.no_grad():
+            value = self.components[key].detach()
+            base = self.sent.get(key) if self.codec.delta else None
+            payload = self.codec.encode(
+                value if base is None else value-base, base)
+            if self.codec.delta:
+                # the receivers decode the same value, the quantization error is sent next round
+                self.sent[key] = self.codec.decode(payload)
+                # only the receivers of the last payload know the base of this one
+                self.base_holders[key] = self.holders.get(key, set())
+                self.holders[key] = set()
+        self.encoded[key] = (self.version, payload)
+        return payload
+
+    def flat_params(self):
+        """
+        concatenate all parameters into a flat tensor
+        """
+        with t.no_grad():
+            return t.cat([param.reshape(-1) for param in self.model.parameters()])
+
+    def num_sparse(self):
+        """
+        the number of elements sent by topk and randk
+        """
+        return max(1, int(self.reference.numel()*self.sparse_ratio))
+
+    def compress(self, indices: t.Tensor = None):
+        """
+        select the elements of the residual x - reference as the sparse payload of this round,
+        the payload is the same for all neighbors
+        ------
+        Parameters:
+            indices: the shared indices of randk, if None, select the top-k elements of the residual
+        Returns:
+            the sorted indices and the values of the payload
+        """
+        with t.no_grad():
+            residual = self.flat_params().sub_(self.reference)
+            if indices is None:
+                indices = residual.abs().topk(
+                    self.num_sparse(), sorted=False).indices.sort().values
+            self.payload = (indices, residual[indices])
+        self.payload_norms = {}
+        return self.payload
+
+    def payload_chunk_norms(self, num_chunks: int):
+        """
+        the payload is split over the subcarriers, get the 2nd-norm of every chunk
+        ------
+        Parameters:
+            num_chunks: the number of subcarriers
+        Returns:
+            list: the norms of the chunks
+        """
+        if num_chunks not in self.payload_norms:
+            self.payload_norms[num_chunks] = calculate_norms(
+                list(self.payload[1].tensor_split(num_chunks)))
+        return self.payload_norms[num_chunks]
+
+    def knows_reference(self, receiver: int):
+        """
+        whether the receiver knows the current reference copy of this client
+        """
+        return self.reference_holders is None or receiver in self.reference_holders
+
+    def update_reference(self):
+        """
+        the reference copy moves forward by the payload after it has been sent,
+        only the receivers of the payload know the new reference copy
+        """
+        with t.no_grad():
+            indices, values = self.payload
+            self.reference.index_add_(0, indices, values)
+        self.payload = None
+        self.payload_norms = {}
+        self.reference_holders = self.receivers
+        self.receivers = set()
+
+    def rcv_flat(self, mixed: t.Tensor, self_weight: float):
+        """
+        update all parameters with the mixed reference copies of the neighbors, x = W_ii*x + mixed
+        ------
+        Parameters:
+            mixed: the flat sum of the weighted reference copies and the amended payload
+            self_weight: the W_ii of the client
+        """
+        offset = 0
+        with t.no_grad():
+            for param in self.model.parameters():
+                param.mul_(float(self_weight)).add_(
+                    mixed[offset:offset+param.numel()].view_as(param))
+                offset += param.numel()
+        self.invalidate_norms()
 
     def train(self,):
         """
@@ -145,12 +359,13 @@ class LocalClient(object):
             for (X, y) in self.train_loader:
                 X = X.to(self.device)
                 y = y.to(self.device)
-                y_hat = self.model.forward(X)
+                y_hat = self.forward(X)
                 loss = self.loss_func.forward(y_hat, y)
                 self.optimizer.zero_grad()
                 loss.backward()
                 self.optimizer.step()
                 ep_loss.append(loss.item())
+        self.invalidate_norms()
 
         return np.mean(ep_loss)
 
@@ -170,15 +385,42 @@ class LocalClient(object):
             for (X, y) in self.test_loader:
                 X = X.to(self.device)
                 y = y.to(self.device)
-                y_hat = self.model.forward(X)
+                y_hat = self.test_forward(X)
                 loss = self.loss_func.forward(y_hat, y)
                 sum_loss.append(loss.item())
                 y_prediction = y_hat.data.max(1, keepdim=True)[1]
                 correct += y_prediction.eq(y.data.view_as(y_prediction)
                                            ).long().cpu().sum()
 
+        self.finish_test()
         return np.mean(sum_loss), 100.*correct / len(self.test_loader.dataset)
 
+    def forward(self, X: t.Tensor):
+        """
+        the forward pass of the local model, with the execution options of the runner if any
+        """
+        if self.runner is None:
+            return self.model.forward(X)
+        return self.runner.forward(self.model, X)
+
+    def test_forward(self, X: t.Tensor):
+        """
+        the forward pass of the evaluation, the BatchNorm layers are folded once
+        per version of the parameters if fold_bn
+        """
+        if not self.fold_bn:
+            return self.forward(X)
+        if self.folded is None or self.folded[0] != self.version:
+            self.folded = (self.version, fold_conv_bn(self.model))
+        return self.folded[1].forward(X)
+
+    def finish_test(self):
+        """
+        the unfolded test pass updates the running statistics, which are components if transmit_buffers
+        """
+        if self.transmit_buffers and not self.fold_bn:
+            self.invalidate_norms()
+
     def generate_mask(self):
         """
         generates the mask according to the subcarrier number
@@ -187,39 +429,173 @@ class LocalClient(object):
             a list of the parameters that should be chosen
         """
         if self.comp_strategy == "random":
-            param_keys = []
-            for name, _ in self.model.named_parameters():
-                if "weight" in name or "bias" in name:
-                    param_keys.append(name)
+            param_keys = list(self.component_keys)
             random.shuffle(param_keys)
             return param_keys[:self.sub_carrier_num]
         elif self.comp_strategy == "weight":
-            weight_dict = calculate_weight_norm(self.model)
+            weight_dict = self.weight_norm()
             weight_keys = [item[0]
                            for item in weight_dict][:self.sub_carrier_num]
             return weight_keys
         elif self.comp_strategy == "grad":
-            grad_dict = calculate_grad_norm(self.model)
+            grad_dict = self.grad_norm()
             grad_keys = [item[0] for item in grad_dict][:self.sub_carrier_num]
             return grad_keys
 
+    def invalidate_norms(self):
+        """
+        mark the cached norms as stale, must be called whenever the parameters change
+        """
+        self.version += 1
+
+    def cached_norms(self, kind: str):
+        """
+        get the 2nd-norm of all components, they are computed with one batched call
+        and cached until the parameters change
+        ------
+        Parameters:
+            kind: weight or grad
+        Returns:
+            dict: the norms in the order of the components
+        """
+        if kind not in self.norm_cache or self.norm_cache[kind][0] != self.version:
+            tensors = []
+            for name in self.component_keys:
+                tensor = self.components[name]
+                if kind == "grad":
+                    # the buffers have no gradient, they are ranked last
+                    tensor = tensor.grad if isinstance(
+                        tensor, nn.Parameter) else t.zeros_like(tensor)
+                tensors.append(tensor)
+            self.norm_cache[kind] = (
+                self.version, dict(zip(self.component_keys, calculate_norms(tensors))))
+        return self.norm_cache[kind][1]
+
+    def weight_norm(self, component_keys: list[str] = None):
+        """
+        the cached version of calculate_weight_norm
+        """
+        weight_norm = self.cached_norms("weight")
+        if component_keys is not None:
+            component_keys = set(component_keys)
+            return {k: v for k, v in weight_norm.items() if k in component_keys}
+        return sorted(weight_norm.items(), key=lambda x: x[1], reverse=True)
+
+    def grad_norm(self):
+        """
+        the cached version of calculate_grad_norm
+        """
+        return sorted(self.cached_norms("grad").items(), key=lambda x: x[1], reverse=True)
+
+
+def load_data(args: dict):
+    """
+    load and split the dataset, the numpy random state is seeded first
+    ------
+    Parameters:
+        args: the configuration
+    Returns:
+        the train_loader of each client, the train_loader, the test_loader and
+        the numpy random state after the split
+    """
+    np.random.seed(args["seed"])
+    if args["dataset"] == "MNIST":
+        dataloader_allusr, train_loader, test_loader = load_mnist(
+            args["iid"], args["num_clients"], args["batch_size"], args.get("data_backend", "torchvision"), args["seed"],
+            args.get("partition", None), args.get("dirichlet_alpha", 0.5))
+    elif args["dataset"] == "CIFAR10":
+        dataloader_allusr, train_loader, test_loader = load_cifar10(
+            args["iid"], args["num_clients"], args["batch_size"], args.get("data_backend", "torchvision"), args.get("augment", "pil"), args["seed"],
+            args.get("partition", None), args.get("dirichlet_alpha", 0.5))
+    else:
+        raise ValueError(
+            "only support MNIST and CIFAR10")
+    return dataloader_allusr, train_loader, test_loader, np.random.get_state()
+
+
+def build_model(args: dict) -> nn.Module:
+    """
+    create the model of the clients
+    ------
+    Parameters:
+        args: the configuration
+    Returns:
+        the model, the clients get deep copies of it
+    """
+    if args["dataset"] == "MNIST":
+        num_channels = 1
+        num_classes = 10
+        image_size = 28
+    elif args["dataset"] == "CIFAR10":
+        num_channels = 3
+        num_classes = 10
+        image_size = 32
+    if args["model_name"] == "resnet-18":
+        net = resnet18.Resnet18(num_channels, num_classes)
+    elif args["model_name"] == "CNN":
+        net = CNN.CNN(num_channels, num_classes, image_size)
+    elif args["model_name"] == "CNN-slim":
+        net = CNN.SlimCNN(num_channels, num_classes, image_size)
+    else:
+        raise ValueError(
+            "only support resnet-18, CNN and CNN-slim, pls check the model_name")
+    return net
+
+
+# the ratios of the subcarrier number to the number of the weight layers, the clients are
+# split evenly into one group per ratio
+SUB_CARRIER_RATIOS = {
+    "MNIST": {"no-limit": [1.],
+              "restricted-1": [0.5],
+              "restricted-2": [0.75, 0.5, 0.25],
+              "restricted-3": [0.1]},
+    "CIFAR10": {"no-limit": [1.],
+                "restricted-1": [0.6],
+                "restricted-2": [0.8, 0.6, 0.4],
+                "restricted-3": [0.3]},
+}
+
+
+def get_sub_carrier_nums(args: dict, weight_num: int) -> list[int]:
+    """
+    the subcarrier number of each client according to the sub_carrier_strategy,
+    the restricted strategies shuffle the numbers with the python random module
+    ------
+    Parameters:
+        args: the configuration
+        weight_num: the number of the weight layers of the model
+    Returns:
+        the subcarrier number of each client
+    """
+    num_clients = args["num_clients"]
+    if args["sub_carrier_strategy"] not in SUB_CARRIER_RATIOS[args["dataset"]]:
+        raise ValueError(
+            "only support no-limit, restricted-1, restricted-2,restricted-3")
+    ratios = SUB_CARRIER_RATIOS[args["dataset"]][args["sub_carrier_strategy"]]
+    sub_carrier_nums = []
+    for idx, ratio in enumerate(ratios):
+        # the first groups get the remaining clients, every client has at least one subcarrier,
+        # which matters for the small models with only a few weight layers
+        group_size = num_clients//len(ratios) + \
+            (1 if idx < num_clients % len(ratios) else 0)
+        sub_carrier_nums += [max(1, int(weight_num*ratio))
+                             for _ in range(group_size)]
+    if args["sub_carrier_strategy"] != "no-limit":
+        random.shuffle(sub_carrier_nums)
+    return sub_carrier_nums
+
 
 class DLLSOA(object):
-    def __init__(self, args: dict):
+    def __init__(self, args: dict, data: tuple = None):
+        """
+        Parameters:
+        -------
+        args: the configuration
+        data: the result of load_data, it can be shared by the runs with the same dataset,
+            None means loading the dataset
+        """
         # save arguments to member variables
-        if args["dataset"] == "MNIST":
-            num_channels = 1
-            num_classes = 10
-        elif args["dataset"] == "CIFAR10":
-            num_channels = 3
-            num_classes = 10
-        if args["model_name"] == "resnet-18":
-            net = resnet18.Resnet18(num_channels, num_classes)
-        elif args["model_name"] == "CNN":
-            net = None  # not implemented yet
-        else:
-            raise ValueError(
-                "only support resnet-18 and CNN, pls check the model_name")
+        net = build_model(args)
         self.device = t.device(
             "cuda") if args["cuda"] and t.cuda.is_available() else t.device("cpu")
         if self.device == t.device("cuda"):
@@ -234,68 +610,15 @@ class DLLSOA(object):
         self.beta_noise = args["beta_noise"]
         self.aggregation_mode = args["aggregation_mode"]
         self.disable_com = args["disable_com"]
-        np.random.seed(self.seed)
         # split datasets
-        if args["dataset"] == "MNIST":
-            dataloader_allusr, train_loader, test_loader = load_mnist(
-                args["iid"], args["num_clients"], args["batch_size"],)
-        elif args["dataset"] == "CIFAR10":
-            dataloader_allusr, train_loader, test_loader = load_cifar10(
-                args["iid"], args["num_clients"], args["batch_size"],)
-        else:
-            raise ValueError(
-                "only support MNIST and CIFAR10")
+        if data is None:
+            data = load_data(args)
+        dataloader_allusr, train_loader, test_loader, numpy_state = data
+        np.random.set_state(numpy_state)
 
         # get the subcarrier num
-        weight_num = get_weight_num(net)
-        # MNIST
-        if args["dataset"] == "MNIST":
-            if args["sub_carrier_strategy"] == "no-limit":
-                sub_carrier_nums = [
-                    weight_num for _ in range(self.num_clients)]
-            elif args["sub_carrier_strategy"] == "restricted-1":
-                sub_carrier_nums = [int(weight_num*0.5)
-                                    for _ in range(self.num_clients)]
-                random.shuffle(sub_carrier_nums)
-            elif args["sub_carrier_strategy"] == "restricted-2":
-                sub_carrier_nums = [int(weight_num*0.75)
-                                    for _ in range(int(self.num_clients/3))]
-                sub_carrier_nums += [int(weight_num*0.5)
-                                     for _ in range(int(self.num_clients/3))]
-                sub_carrier_nums += [int(weight_num*0.25)
-                                     for _ in range(int(self.num_clients/3))]
-                random.shuffle(sub_carrier_nums)
-            elif args["sub_carrier_strategy"] == "restricted-3":
-                sub_carrier_nums = [int(weight_num*0.1)
-                                    for _ in range(self.num_clients)]
-                random.shuffle(sub_carrier_nums)
-            else:
-                raise ValueError(
-                    "only support no-limit, restricted-1, restricted-2,restricted-3")
-        # CIFAR10
-        elif args["dataset"] == "CIFAR10":
-            if args["sub_carrier_strategy"] == "no-limit":
-                sub_carrier_nums = [
-                    weight_num for _ in range(self.num_clients)]
-            elif args["sub_carrier_strategy"] == "restricted-1":
-                sub_carrier_nums = [int(weight_num*0.6)
-                                    for _ in range(self.num_clients)]
-                random.shuffle(sub_carrier_nums)
-            elif args["sub_carrier_strategy"] == "restricted-2":
-                sub_carrier_nums = [int(weight_num*0.8)
-                                    for _ in range(int(self.num_clients/3))]
-                sub_carrier_nums += [int(weight_num*0.6)
-                                     for _ in range(int(self.num_clients/3))]
-                sub_carrier_nums += [int(weight_num*0.4)
-                                     for _ in range(int(self.num_clients/3))]
-                random.shuffle(sub_carrier_nums)
-            elif args["sub_carrier_strategy"] == "restricted-3":
-                sub_carrier_nums = [int(weight_num*0.3)
-                                    for _ in range(self.num_clients)]
-                random.shuffle(sub_carrier_nums)
-            else:
-                raise ValueError(
-                    "only support no-limit, restricted-1, restricted-2,restricted-3")
+        weight_num = get_weight_num(net, args.get("transmit_buffers", False))
+        sub_carrier_nums = get_sub_carrier_nums(args, weight_num)
         # create clients
         self.clients = [
             LocalClient(
@@ -314,33 +637,160 @@ class DLLSOA(object):
                               sub_carrier_nums[i])),
                 self.pow_limit,
                 args["pow_allocation_strategy"],
+                args.get("sparse_ratio", 0.01),
+                args.get("transmit_buffers", False),
+                args.get("fold_bn", False),
             )
             for i in range(self.num_clients)
         ]
+        # the cpu execution options of the forward pass, the runner is shared by all clients
+        self.runner = ModelRunner(net, args.get("channels_last", False),
+                                  args.get("autocast", "none"), args.get("compile", False))
+        if self.runner.channels_last and args.get("engine", "module") != "module":
+            raise ValueError("channels_last only supports the module engine")
+        if self.runner.enabled:
+            for client in self.clients:
+                self.runner.prepare(client.model)
+                client.runner = self.runner
+        self.execution_report = args.get("execution_report", False)
+        # keep the parameters of all clients in a flat buffer if required
+        self.engine = None
+        self.optimizer = None
+        if args.get("engine", "module") == "flat":
+            self.engine = FlatParamEngine(
+                [client.model for client in self.clients], self.device)
+            self.optimizer = FlatAdam(self.engine, args["lr"])
+            for client in self.clients:
+                client.optimizer = self.optimizer.view(client.id)
+        elif args.get("engine", "module") != "module":
+            raise ValueError("only support module and flat engine")
+        # topk and randk send the elements of the parameters instead of whole layers
+        self.comp_strategy = args["comp_strategy"]
+        if self.comp_strategy in ("topk", "randk") and self.engine is not None:
+            raise ValueError("topk and randk only support the module engine")
+        # the running statistics of BatchNorm are transmitted as components if required
+        if args.get("transmit_buffers", False) and (self.engine is not None or self.comp_strategy in ("topk", "randk")):
+            raise ValueError(
+                "transmit_buffers only supports the module engine with random, weight and grad")
+        # encode the transmitted components if required
+        codec = args.get("codec", "none")
+        codec_delta = args.get("codec_delta", False)
+        self.codec = None
+        if codec != "none" or codec_delta:
+            if self.engine is not None or self.comp_strategy in ("topk", "randk"):
+                raise ValueError(
+                    "the payload codec only supports the module engine with random, weight and grad")
+            self.codec = PayloadCodec(codec, codec_delta, self.seed)
+            for client in self.clients:
+                client.codec = self.codec
+        # train all clients with vmap if required
+        self.train_mode = args.get("train_mode", "sequential")
+        if self.train_mode == "vmap":
+            if self.engine is None:
+                raise ValueError("vmap training requires the flat engine")
+            if self.runner.enabled:
+                raise ValueError(
+                    "channels_last, autocast and compile only support sequential train_mode")
+            self.trainer = VmapTrainer(self.engine, self.optimizer, [client.model for client in self.clients],
+                                       nn.CrossEntropyLoss(), args.get("vmap_chunk", None))
+        elif self.train_mode != "sequential":
+            raise ValueError("only support sequential and vmap train_mode")
+        # train the clients in worker processes if required
+        self.num_workers = args.get("num_workers", 0)
+        self.worker_threads = args.get("worker_threads", None)
+        self.pool = None
+        if self.num_workers > 0:
+            if self.device != t.device("cpu"):
+                raise ValueError("the worker pool only supports cpu")
+            if self.train_mode == "vmap":
+                raise ValueError(
+                    "the worker pool only supports sequential train_mode")
+            if self.runner.compile:
+                # the workers are forked, which is not supported once a compiled backward has run
+                raise ValueError("the worker pool does not support compile")
+        # sync runs the rounds in lockstep, async simulates the clients with their own
+        # compute speed and link latency, see train_async
+        self.execution = args.get("execution", "sync")
+        if self.execution == "async":
+            if self.engine is not None or self.comp_strategy in ("topk", "randk") or self.num_workers > 0:
+                raise ValueError(
+                    "the asynchronous mode only supports the module engine with random, weight and grad in the main process")
+        elif self.execution != "sync":
+            raise ValueError("only support sync and async execution")
+        self.speed_spread = args.get("speed_spread", 0.5)
+        self.latency = args.get("latency", 0.1)
+        # the receive buffers of the over-the-air aggregation
+        self.accumulator = OTAAccumulator()
+        # the topology of the network, dense is the random graph of gen_topo,
+        # the others are generated in the CSR form with their own random number generator
+        self.topology = args.get("topology", "dense")
+        self.topo_degree = args.get("topo_degree", 4)
+        self.topo_radius = args.get("topo_radius", 0.1)
+        self.topo_rng = np.random.default_rng(self.seed)
+        # legacy generates a new graph at the beginning of every round, the others
+        # are static, resampled every topo_every rounds or replayed from topo_file
+        self.schedule = None
+        self.graph = None
+        topo_schedule = args.get("topo_schedule", "legacy")
+        if topo_schedule != "legacy":
+            self.schedule = TopologySchedule(self.topology, self.num_clients, topo_schedule,
+                                             args.get("topo_every", 1), self.seed,
+                                             self.topo_degree, self.topo_radius,
+                                             args.get("topo_file", None), self.train_epoch)
         # init some variables such as connetivity matrix
         self.init_weight()
-        self.xi = np.zeros((self.num_clients, self.num_clients))
+        # the dense xi keeps the entries of the former neighbors, it is only kept with the dense W
+        self.xi = np.zeros((self.num_clients, self.num_clients)
+                           ) if self.W is not None else None
         # tensorboardX
         log_dir = os.path.join(args["log_dir"], args["dataset"], time.strftime(
             "%Y-%m-%d-%H-%M-%S", time.localtime()))
         create_folder(log_dir)
+        self.log_dir = log_dir
         self.writer = SummaryWriter(log_dir)
         # save the configuration as a dictionary
         with open(os.path.join(log_dir, "config.yaml"), "w") as f:
             yaml.dump(args, f)
+        # time the phases of every round, the selected rounds are also traced by torch.profiler
+        self.profiler = RoundProfiler(self.writer, log_dir, args.get("profile", False),
+                                      args.get("profile_rounds", None), self.device)
+        # the train loss of the first round computed by a shared prefix, see fork
+        self.prefix_losses = None
+        # save the whole simulation every checkpoint_every rounds, 0 means never
+        self.start_round = 0
+        self.worker_rng = None
+        self.checkpoint_every = args.get("checkpoint_every", 0)
+        self.checkpoint_path = args.get("checkpoint_path", None) or os.path.join(
+            log_dir, "checkpoint.pt")
+        self.checkpoint_writer = None
+        if self.execution == "async" and self.checkpoint_every > 0:
+            raise ValueError("the asynchronous mode does not support checkpoints")
 
-    def init_weight(self,):
+    def init_weight(self, round: int = 0):
         """
         initialize the adjacency matrix and the weight matrix w
         ------
         Parameters:
-            None
+            round: the index of the training round
         Returns:
             None
         """
-        # init w
-        topo = gen_topo(self.num_clients)
-        self.W = init_w(topo)
+        if self.schedule is not None:
+            graph = self.schedule.graph(round)
+            if graph is not self.graph:
+                self.graph = graph
+                # the dense W is only required by the dense topology and the flat engine
+                self.W = graph.to_dense() if self.topology == "dense" or self.engine is not None else None
+        elif self.topology == "dense":
+            # init w
+            topo = gen_topo(self.num_clients)
+            self.W = init_w(topo)
+            self.graph = Graph.from_dense(self.W)
+        else:
+            self.graph = generate_graph(self.topology, self.num_clients, self.topo_rng,
+                                        self.topo_degree, self.topo_radius)
+            # the flat engine mixes all pairs at once and needs the dense matrix anyway
+            self.W = self.graph.to_dense() if self.engine is not None else None
 
     def train(self):
         """
@@ -351,49 +801,192 @@ class DLLSOA(object):
         Returns:
             None
         """
-        # here simply use for loop instead of multiprocessing
-        # todo: use multiprocessing
+        if self.execution == "async":
+            self.train_async()
+            return
+        self.start_pool()
         print("training begin...")
         #print("the randomly generated W is: \n", self.W)
-        for ep in tqdm(range(self.train_epoch)):
+        # the number of samples trained in a round
+        samples = sum(len(client.train_loader.dataset)
+                      for client in self.clients)*self.clients[0].ep_num
+        for ep in tqdm(range(self.start_round, self.train_epoch)):
+            self.profiler.begin(ep)
+            with self.profiler.phase("topology"):
+                self.init_weight(ep)
             # local training
-            self.init_weight()
-            losses = [client.train() for client in self.clients]
+            if self.prefix_losses is not None:
+                # the first local update phase has been computed by the prefix
+                losses, self.prefix_losses = self.prefix_losses, None
+            else:
+                with self.profiler.phase("local_update"):
+                    losses = self.local_update()
             data_amount = 0
             data_size = 0
             if not self.disable_com:
-                for i in range(self.num_clients):
-                    # 1. generate mask of components
-                    mask = self.clients[i].generate_mask()
-                    channel_gains = self.clients[i].channel_gain
-                    rcv_models = []
-                    # 2. send the mask to all neighbors and receive parameters
-                    for j in range(self.num_clients):
-                        if self.W[i][j] != 0. and i != j:
-                            model, self.xi[i][j] = self.clients[j].send_params(
-                                mask, self.W[i][j], channel_gains[i], self.beta, self.beta_noise)
-                            rcv_models.append(model)
-                    # 3. begin aggregation
-                    sigma = calculate_agg_var(
-                        self.W, i, self.sigma, self.aggregation_mode)
-                    processed_model = aggregation(
-                        rcv_models, sigma)
-                    # 4. perform gradient descent and update parameters
-                    self.clients[i].rcv_params(
-                        processed_model, self.xi[i], self.W[i], self.amendment_strategy)
-                    # 5. calculate the communication data amount
-                    size, amount = calculate_data_amount(rcv_models)
-                    data_size += size
-                    data_amount += amount
-            # Tensorboard logs and print loss
-            test_loss_acc = [client.test() for client in self.clients]
+                if self.engine is not None:
+                    data_size, data_amount = self.communicate_flat()
+                elif self.comp_strategy in ("topk", "randk"):
+                    data_size, data_amount = self.communicate_sparse(ep)
+                else:
+                    data_size, data_amount = self.communicate()
+            with self.profiler.phase("evaluation"):
+                test_loss_acc = self.test()
+            self.log(ep, losses, test_loss_acc, data_size, data_amount)
+            if self.checkpoint_every > 0 and (ep+1) % self.checkpoint_every == 0:
+                with self.profiler.phase("checkpoint"):
+                    self.save_checkpoint(ep+1)
+            self.profiler.end(ep, samples)
+        if self.execution_report:
+            self.report_execution()
+        self.close()
+
+    def train_async(self):
+        """
+        the asynchronous training procedure. Every client has a simulated compute speed and
+        link latency, the local updates and the over-the-air exchanges are events of a priority
+        queue ordered by the simulated time. A client receives from its neighbors as soon as its
+        local update and the exchange are done and starts the next local update immediately,
+        so the stragglers do not block the others. A round is num_clients exchanges, the clients
+        are evaluated and the topology is updated every round.
+        ------
+        Parameters:
+            None
+        Returns:
+            None
+        """
+        print("asynchronous training begin...")
+        # the speeds and latencies have their own random number generator,
+        # the mean local update time is the unit of the simulated time
+        rng = np.random.default_rng(self.seed)
+        compute_time = rng.lognormal(-self.speed_spread**2/2, self.speed_spread,
+                                     self.num_clients)
+        latency = self.latency * \
+            rng.lognormal(-self.speed_spread**2/2, self.speed_spread, self.num_clients)
+        samples = sum(len(client.train_loader.dataset)
+                      for client in self.clients)*self.clients[0].ep_num
+        # the events are (time, sequence, kind, client), the sequence breaks the ties
+        events = [(compute_time[i], i, "train", i)
+                  for i in range(self.num_clients)]
+        heapq.heapify(events)
+        sequence = self.num_clients
+        # the last train loss of each client, nan before its first local update
+        losses = [np.nan for _ in range(self.num_clients)]
+        updates = np.zeros(self.num_clients, dtype=np.int64)
+        data_size, data_amount = 0, 0
+        exchanges = 0
+        ep = self.start_round
+        progress = tqdm(total=self.train_epoch-ep)
+        self.profiler.begin(ep)
+        sigmas = calculate_agg_var_graph(
+            self.graph, self.sigma, self.aggregation_mode)
+        while ep < self.train_epoch:
+            now, _, kind, i = heapq.heappop(events)
+            if kind == "train":
+                # 1. the local update is done, the exchange starts
+                with self.profiler.phase("local_update"), self.profiler.client(i):
+                    losses[i] = self.clients[i].train()
+                updates[i] += 1
+                heapq.heappush(
+                    events, (now+latency[i], sequence, "exchange", i))
+                sequence += 1
+                continue
+            # 2. the exchange is done, the next local update starts
+            if not self.disable_com:
+                size, amount = self.receive(i, sigmas)
+                data_size += size
+                data_amount += amount
+            heapq.heappush(
+                events, (now+compute_time[i], sequence, "train", i))
+            sequence += 1
+            exchanges += 1
+            if exchanges % self.num_clients != 0:
+                continue
+            # 3. a round of exchanges is done
+            with self.profiler.phase("evaluation"):
+                test_loss_acc = self.test()
+            self.log(ep, losses, test_loss_acc, data_size, data_amount)
+            self.writer.add_scalar("simulated_time", now, ep)
+            self.writer.add_scalar("local_updates_min", updates.min(), ep)
+            self.writer.add_scalar("local_updates_max", updates.max(), ep)
+            self.profiler.end(ep, samples)
+            progress.update(1)
+            data_size, data_amount = 0, 0
+            ep += 1
+            if ep < self.train_epoch:
+                self.profiler.begin(ep)
+                with self.profiler.phase("topology"):
+                    self.init_weight(ep)
+                sigmas = calculate_agg_var_graph(
+                    self.graph, self.sigma, self.aggregation_mode)
+        progress.close()
+        if self.execution_report:
+            self.report_execution()
+        self.close()
+
+    def close(self):
+        """
+        stop the worker pool, the topology schedule, the checkpoint writer and the profiler
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.schedule is not None:
+            self.schedule.close()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            self.checkpoint_writer = None
+        self.profiler.close()
+
+    def report_execution(self, num_batches: int = 10):
+        """
+        compare the execution options with the fp32 eager execution on the trained model of
+        client 0, the step time and the test accuracy of every option are written to the
+        tensorboard and execution_report.json in the log directory
+        ------
+        Parameters:
+            num_batches: the number of test batches of the accuracy
+        """
+        client = self.clients[0]
+        X, y = next(iter(client.train_loader))
+        test_batches = []
+        for X_test, y_test in client.test_loader:
+            test_batches.append((X_test.to(self.device), y_test.to(self.device)))
+            if len(test_batches) == num_batches:
+                break
+        report = execution_report(self.runner, client.model, client.loss_func,
+                                  (X.to(self.device), y.to(self.device)), test_batches)
+        for option, result in report.items():
+            for key, value in result.items():
+                self.writer.add_scalar(f"execution/{option}/{key}", value)
+            print(f"{option}: step {result['step_ms']:.2f} ms, speedup {result['speedup']:.2f}x, "
+                  f"test_acc {result['test_acc']:.2f}, acc_delta {result['acc_delta']:+.2f}")
+        with open(os.path.join(self.log_dir, "execution_report.json"), "w") as f:
+            json.dump(report, f, indent=2)
+
+    def log(self, ep: int, losses: list, test_loss_acc: list, data_size: int, data_amount: int):
+        """
+        Tensorboard logs and print loss
+        ------
+        Parameters:
+            ep: the index of the round
+            losses: the train loss of each client, nan if the client has not trained yet
+            test_loss_acc: the test loss and accuracy of each client
+            data_size: the communication data size
+            data_amount: the communication data amount
+        """
+        # in the asynchronous mode, the slow clients may not have trained in the first rounds
+        trained = [i for i in range(len(losses)) if not np.isnan(losses[i])]
+        with self.profiler.phase("logging"):
             [self.writer.add_scalar("test_loss_client_{}".format(
                 i), test_loss_acc[i][0], ep) for i in range(len(test_loss_acc))]
             [self.writer.add_scalar("test_acc_client_{}".format(
                 i), test_loss_acc[i][1], ep) for i in range(len(test_loss_acc))]
             [self.writer.add_scalar("train_loss_client_{}".format(
-                i), losses[i], ep) for i in range(len(losses))]
-            self.writer.add_scalar("mean_train_loss", np.mean(losses), ep)
+                i), losses[i], ep) for i in trained]
+            if len(trained) != 0:
+                self.writer.add_scalar("mean_train_loss", np.mean(
+                    [losses[i] for i in trained]), ep)
             self.writer.add_scalar("mean_test_loss", np.mean(
                 [test_loss_acc[i][0] for i in range(len(test_loss_acc))]), ep)
             self.writer.add_scalar("mean_test_acc", np.mean(
@@ -403,8 +996,363 @@ class DLLSOA(object):
             print(
                 f"ep:[{ep}/{self.train_epoch}],train_loss:{losses},test_loss_acc:{test_loss_acc}")
 
+    def start_pool(self):
+        """
+        start the worker pool of the local update phase if num_workers > 0
+        """
+        if self.num_workers > 0 and self.pool is None:
+            self.pool = ClientPool(self.clients, self.num_workers, self.worker_threads,
+                                   self.engine, self.optimizer, self.seed, self.worker_rng)
+
+    def fork(self, state: dict, losses: list):
+        """
+        continue from a shared prefix, i.e. the first local update phase of a run with the same
+        dataset, seed, initialization and training settings, see sweep.py. Only the models,
+        the optimizers and the random states of the training are taken from the prefix, the
+        communication settings and their random states belong to this run.
+        ------
+        Parameters:
+            state: the snapshot of the prefix after its first local update phase
+            losses: the train loss of the prefix
+        Returns:
+            None
+        """
+        if self.pool is not None:
+            raise ValueError(
+                "the prefix must be loaded before the worker pool starts")
+        if self.execution == "async":
+            # the asynchronous mode trains the clients in the order of the simulated time
+            raise ValueError("the asynchronous mode does not support a shared prefix")
+        restore_clients(self, state)
+        restore_torch_rng(self, state)
+        self.prefix_losses = losses
+
+    def save_checkpoint(self, round: int):
+        """
+        take a snapshot of the simulation and write it in a background thread
+        ------
+        Parameters:
+            round: the index of the next training round
+        Returns:
+            None
+        """
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter()
+        self.checkpoint_writer.save(capture_state(
+            self, round), self.checkpoint_path)
+
+    def load_checkpoint(self, path: str):
+        """
+        resume the simulation from a checkpoint, the configuration must be the same
+        ------
+        Parameters:
+            path: the path of the checkpoint
+        Returns:
+            None
+        """
+        if self.pool is not None:
+            raise ValueError(
+                "the checkpoint must be loaded before the worker pool starts")
+        self.start_round = restore_state(self, load_checkpoint(path))
+
+    def local_update(self):
+        """
+        the local update phase, every client trains its model for a round
+        ------
+        Parameters:
+            None
+        Returns:
+            the train loss of each client
+        """
+        if self.train_mode == "vmap":
+            losses = self.trainer.train(
+                [client.train_loader for client in self.clients], self.clients[0].ep_num)
+        elif self.pool is not None:
+            losses = self.pool.train()
+        else:
+            losses = []
+            for client in self.clients:
+                with self.profiler.client(client.id):
+                    losses.append(client.train())
+        # the parameters may be updated outside of LocalClient.train
+        for client in self.clients:
+            client.invalidate_norms()
+        return losses
+
+    def communicate(self):
+        """
+        the communication phase, the clients receive the parameters from their neighbors one by one
+        ------
+        Parameters:
+            None
+        Returns:
+            the communication data size and data amount
+        """
+        data_amount = 0
+        data_size = 0
+        sigmas = calculate_agg_var_graph(
+            self.graph, self.sigma, self.aggregation_mode)
+        for i in range(self.num_clients):
+            size, amount = self.receive(i, sigmas)
+            data_size += size
+            data_amount += amount
+        return data_size, data_amount
+
+    def receive(self, i: int, sigmas: ndarray):
+        """
+        client i receives the parameters from its neighbors through the over-the-air aggregation
+        ------
+        Parameters:
+            i: the id of the receiver
+            sigmas: the variance of the Gaussian noise of each client
+        Returns:
+            the communication data size and data amount
+        """
+        # 1. generate mask of components
+        with self.profiler.phase("mask"):
+            mask = self.clients[i].generate_mask()
+        channel_gains = self.clients[i].channel_gain
+        neighbors, weights = self.graph.neighbors(i)
+        xi = np.zeros(0)
+        self.accumulator.begin()
+        if len(neighbors) != 0:
+            # 2. compute the power allocation coefficients of all neighbors at once
+            with self.profiler.phase("power"):
+                weight_norm = np.array([list(self.clients[j].weight_norm(mask).values())
+                                        for j in neighbors])
+                beta = np.random.normal(
+                    0.0, self.beta_noise, size=len(neighbors))+self.beta
+                E = calculate_E_batch(
+                    weights, weight_norm, channel_gains[i], beta)
+                b, xi = compute_power_coeff_batch(
+                    E, weights, channel_gains[i], weight_norm, self.pow_limit, self.clients[i].pow_allow_stg)
+            # 3. the neighbors transmit straight into the receive buffers
+            with self.profiler.phase("aggregation"):
+                for k, j in enumerate(neighbors):
+                    self.clients[j].transmit_into(
+                        self.accumulator, mask, b[k], channel_gains[i], i)
+        # 4. add the noise of the channel once
+        with self.profiler.phase("aggregation"):
+            processed_model = self.accumulator.finish(sigmas[i])
+        # 5. perform gradient descent and update parameters
+        with self.profiler.phase("receive"):
+            alpha = self.estimate_alpha(i, neighbors, weights, xi)
+            self.clients[i].rcv_params(
+                processed_model, None, None, self.amendment_strategy, alpha, self.graph.self_weights[i])
+        # 6. the communication data amount is tallied while transmitting
+        return self.accumulator.data_size, self.accumulator.data_amount
+
+    def estimate_alpha(self, i: int, neighbors: ndarray, weights: ndarray, xi: ndarray):
+        """
+        record the xi of the receiver and estimate its alpha
+        ------
+        Parameters:
+            i: the id of the receiver
+            neighbors: the ids of the neighbors
+            weights: the W_ij of the neighbors
+            xi: the xi of the neighbors
+        Returns:
+            the estimated alpha
+        """
+        if self.xi is not None:
+            self.xi[i, neighbors] = xi
+            return compute_alpha_batch([i], self.xi[i:i+1], self.W[i:i+1] if self.amendment_strategy == "eq6" else None,
+                                       self.pow_limit)[0]
+        return compute_alpha_neighbors(
+            xi, weights if self.amendment_strategy == "eq6" else None, self.pow_limit)
+
+    def communicate_sparse(self, round: int):
+        """
+        the communication phase of topk and randk. Every client selects the elements of the
+        residual between its parameters and its reference copy once, and the payload is split
+        over the subcarriers of each receiver. The receivers mix the reference copies of the
+        neighbors and the over-the-air sum of the payloads, the reference copies are resent
+        to the receivers which have missed a payload, e.g. after the topology has changed.
+        ------
+        Parameters:
+            round: the index of the training round, the seed of the shared randk indices
+        Returns:
+            the communication data size and data amount
+        """
+        data_amount = 0
+        data_size = 0
+        sigmas = calculate_agg_var_graph(
+            self.graph, self.sigma, self.aggregation_mode)
+        numel = self.clients[0].reference.numel()
+        # 1. select the payload of every client
+        indices = None
+        index_size = 4  # the indices are sent as int32
+        if self.comp_strategy == "randk":
+            # the receivers regenerate the shared indices from the seed, only the values are sent
+            generator = t.Generator().manual_seed(self.seed*1000003+round)
+            indices = t.randperm(numel, generator=generator)[
+                :self.clients[0].num_sparse()].sort().values.to(self.device)
+            index_size = 0
+        with self.profiler.phase("mask"):
+            for client in self.clients:
+                client.compress(indices)
+        for i in range(self.num_clients):
+            channel_gains = self.clients[i].channel_gain
+            neighbors, weights = self.graph.neighbors(i)
+            xi = np.zeros(0)
+            self.accumulator.begin()
+            if len(neighbors) != 0:
+                # 2. compute the power allocation coefficients of the chunks of the payload
+                with self.profiler.phase("power"):
+                    num_chunks = min(len(channel_gains[i]),
+                                     len(self.clients[i].payload[1]))
+                    h = channel_gains[i][:num_chunks]
+                    payload_norm = np.array([self.clients[j].payload_chunk_norms(num_chunks)
+                                             for j in neighbors])
+                    beta = np.random.normal(
+                        0.0, self.beta_noise, size=len(neighbors))+self.beta
+                    E = calculate_E_batch(weights, payload_norm, h, beta)
+                    b, xi = compute_power_coeff_batch(
+                        E, weights, h, payload_norm, self.pow_limit, self.clients[i].pow_allow_stg)
+                # 3. the neighbors transmit the scaled payloads into the receive buffer
+                with self.profiler.phase("aggregation"):
+                    for k, j in enumerate(neighbors):
+                        # a receiver which has missed a payload of j gets the reference copy of j again
+                        if not self.clients[j].knows_reference(i):
+                            self.accumulator.add_resend(
+                                self.clients[j].reference)
+                        self.clients[j].receivers.add(i)
+                        payload_indices, values = self.clients[j].payload
+                        chunk_sizes = [len(chunk)
+                                       for chunk in values.tensor_split(num_chunks)]
+                        scale = t.repeat_interleave(t.from_numpy(b[k]*h).to(values),
+                                                    t.tensor(chunk_sizes, device=values.device))
+                        self.accumulator.add_sparse(
+                            "payload", numel, payload_indices, values*scale, index_size)
+            # 4. add the noise of the channel once
+            with self.profiler.phase("aggregation"):
+                received = self.accumulator.finish(sigmas[i])
+            # 5. mix the reference copies and the amended payload
+            with self.profiler.phase("receive"):
+                alpha = self.estimate_alpha(i, neighbors, weights, xi)
+                if received is not None:
+                    mixed = received["payload"].mul_(float(alpha))
+                    for k, j in enumerate(neighbors):
+                        mixed.add_(self.clients[j].reference,
+                                   alpha=float(weights[k]))
+                    self.clients[i].rcv_flat(mixed, self.graph.self_weights[i])
+            # 6. the true size of the sparse payload is tallied while transmitting
+            data_size += self.accumulator.data_size
+            data_amount += self.accumulator.data_amount
+        with self.profiler.phase("receive"):
+            for client in self.clients:
+                client.update_reference()
+        return data_size, data_amount
+
+    def communicate_flat(self):
+        """
+        the communication phase of the flat engine, all receivers mix the snapshot of
+        the parameters at the beginning of the phase through batched tensor operations
+        ------
+        Parameters:
+            None
+        Returns:
+            the communication data size and data amount
+        """
+        with self.profiler.phase("mask"):
+            num_components = len(self.engine.names)
+            weight_norm = self.engine.segment_norms().cpu().numpy()
+            # 1. generate the masks, padded to the same length
+            masks = [self.clients[i].generate_mask() for i in range(self.num_clients)]
+            max_len = max(len(mask) for mask in masks)
+            # the ids of the components in the order of the mask, padded with a dummy component
+            mask_ids = np.full((self.num_clients, max_len), num_components)
+            # the norms are computed in the order of the parameters, see calculate_weight_norm
+            sorted_ids = np.zeros((self.num_clients, max_len), dtype=np.int64)
+            valid = np.zeros((self.num_clients, max_len), dtype=bool)
+            h = np.ones((self.num_clients, max_len))
+            for i, mask in enumerate(masks):
+                ids = [self.engine.index[key] for key in mask]
+                mask_ids[i, :len(ids)] = ids
+                sorted_ids[i, :len(ids)] = sorted(ids)
+                valid[i, :len(ids)] = True
+                h[i, :len(ids)] = self.clients[i].channel_gain[i]
+        with self.profiler.phase("power"):
+            # 2. compute the power allocation coefficients of all pairs at once
+            W = self.W - np.diag(np.diagonal(self.W))
+            connected = W != 0.
+            # x[i, j] is the norms of the components of sender j masked by receiver i
+            x = weight_norm[np.arange(self.num_clients)[None, :, None],
+                            sorted_ids[:, None, :]]*valid[:, None, :]
+            beta = np.zeros_like(W)
+            beta[connected] = np.random.normal(
+                0.0, self.beta_noise, size=np.count_nonzero(connected))+self.beta
+            E = calculate_E_batch(W, x, h[:, None, :], beta)
+            b, xi = compute_power_coeff_batch(
+                E, W, h[:, None, :], x, self.pow_limit, self.clients[0].pow_allow_stg)
+            self.xi[connected] = xi[connected]
+            coeff = np.where(
+                connected[:, :, None] & valid[:, None, :], b*h[:, None, :], 0.)
+            coeff_full = t.zeros(self.num_clients, self.num_clients,
+                                 num_components+1)
+            coeff_full.scatter_(2, t.from_numpy(mask_ids)[:, None, :].expand(-1, self.num_clients, -1),
+                                t.from_numpy(coeff).float())
+            # 3. compute alpha and the noise of all receivers
+            has_neighbors = connected.any(axis=1)
+            component_masks = t.zeros(self.num_clients, num_components+1,
+                                      dtype=t.bool)
+            component_masks[t.arange(self.num_clients)[:, None],
+                            t.from_numpy(mask_ids)] = True
+            component_masks = component_masks[:, :num_components] & t.from_numpy(
+                has_neighbors)[:, None]
+            if self.amendment_strategy not in ("eq5", "eq6"):
+                raise ValueError(
+                    "Unsupported value, only support eq5 and eq6")
+            alpha = compute_alpha_batch(np.arange(self.num_clients), self.xi,
+                                        self.W if self.amendment_strategy == "eq6" else None, self.pow_limit)
+            alpha = np.where(has_neighbors, alpha, 1.)
+            sigma = calculate_agg_var_batch(
+                self.W, self.sigma, self.aggregation_mode)
+            # 4. calculate the communication data amount
+            numels = np.array(self.engine.numels+[0])
+            numel = numels[mask_ids].sum(axis=1)
+            data_amount = int(np.sum(numel*connected.sum(axis=1)))
+            data_size = data_amount*self.engine.params.element_size()
+        with self.profiler.phase("aggregation"):
+            # 5. aggregate and update the parameters of all receivers at once
+            self.engine.over_the_air(coeff_full[:, :, :num_components], component_masks,
+                                     t.from_numpy(np.diagonal(self.W).copy()).float(),
+                                     t.from_numpy(alpha).float(), t.from_numpy(sigma).float())
+            for client in self.clients:
+                client.invalidate_norms()
+        return data_size, data_amount
+
     def test(self):
         """
-        begin the test procedure
+        begin the test procedure, every test batch is loaded once and
+        evaluated by all client models while it is still in memory
+        ------
+        Parameters:
+            None
+        Returns:
+            the loss and accuracy of the testset of each client,
+            the same as calling client.test() for each client
         """
-        pass
+        test_loader = self.clients[0].test_loader
+        sum_loss = [[] for _ in self.clients]
+        correct = [0 for _ in self.clients]
+        with t.no_grad():
+            for (X, y) in test_loader:
+                X = X.to(self.device)
+                y = y.to(self.device)
+                for i, client in enumerate(self.clients):
+                    y_hat = client.test_forward(X)
+                    sum_loss[i].append(client.loss_func.forward(y_hat, y))
+                    y_prediction = y_hat.data.max(1, keepdim=True)[1]
+                    correct[i] += y_prediction.eq(y.data.view_as(y_prediction)
+                                                  ).long().sum()
+        for client in self.clients:
+            client.finish_test()
+        # client.test() creates an iterator of the test loader for each client and the DataLoader
+        # draws a seed from the global random state for each iterator, the skipped iterators are
+        # created as well so that the random state, and the following rounds, stay the same
+        for _ in self.clients[1:]:
+            iter(test_loader)
+        # synchronize once at the end of the evaluation
+        return [(np.mean(t.stack(sum_loss[i]).cpu().double().numpy()), 100.*correct[i].cpu() / len(test_loader.dataset))
+                for i in range(len(self.clients))]
@@ -0,0 +1,64 @@
+import os
+import time
+import platform
+import subprocess
+import numpy as np
+import torch as t
+
+
+class Skip(Exception):
+    """
+    raised by the setup of a case which can not run on this machine, e.g. out of the memory budget
+    """
+
+
+def measure(fn, setup=None, repeat: int = 5, warmup: int = 1) -> dict:
+    """
+    time a function, the setup is called before every call and is not timed
+    ------
+    Parameters:
+        fn: the function to time, it receives the result of setup
+        setup: the function which prepares the argument of fn, None means fn takes no argument
+        repeat: the number of timed calls
+        warmup: the number of untimed calls before the timed ones
+    Returns:
+        the median, min, mean and max seconds of the timed calls and the repeat
+    """
+    times = []
+    for k in range(warmup+repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn(arg) if setup is not None else fn()
+        elapsed = time.perf_counter()-start
+        if k >= warmup:
+            times.append(elapsed)
+    return {"median": float(np.median(times)),
+            "min": float(np.min(times)),
+            "mean": float(np.mean(times)),
+            "max": float(np.max(times)),
+            "repeat": repeat}
+
+
+def case_id(name: str, **params) -> str:
+    """
+    the stable id of a case, the parameters are sorted by name
+    """
+    return "/".join([name]+[f"{key}={params[key]}" for key in sorted(params)])
+
+
+def environment() -> dict:
+    """
+    the description of the machine and the code, stored with the results
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit,
+            "python": platform.python_version(),
+            "torch": t.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "num_threads": t.get_num_threads()}
@@ -0,0 +1,62 @@
+import sys
+import json
+import argparse
+
+
+def compare(old: dict, new: dict, threshold: float, min_seconds: float):
+    """
+    compare the median times of the cases of two result files
+    ------
+    Parameters:
+        old: the results of the baseline
+        new: the results to check
+        threshold: the relative slowdown which counts as a regression
+        min_seconds: the cases faster than it in both files are too noisy and never regress
+    Returns:
+        the rows (id, old median, new median, ratio) and the ids of the regressions
+    """
+    rows = []
+    regressions = []
+    for id in sorted(set(old) & set(new)):
+        if "median" not in old[id] or "median" not in new[id]:
+            continue
+        before, after = old[id]["median"], new[id]["median"]
+        ratio = after/before if before > 0 else float("inf")
+        rows.append((id, before, after, ratio))
+        if ratio > 1+threshold and max(before, after) >= min_seconds:
+            regressions.append(id)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="compare_benchmarks", description="compare two result files of benchmarks/run.py"
+    )
+    parser.add_argument("old", type=str, help="the results of the baseline")
+    parser.add_argument("new", type=str, help="the results to check")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="the relative slowdown which counts as a regression")
+    parser.add_argument("--min-seconds", type=float, default=1e-4,
+                        help="the cases faster than it are not checked")
+    compare_arg = parser.parse_args()
+    with open(compare_arg.old) as f:
+        old = json.load(f)
+    with open(compare_arg.new) as f:
+        new = json.load(f)
+    for key in ("cpu_count", "num_threads", "torch"):
+        if old["environment"].get(key) != new["environment"].get(key):
+            print(f"warning: {key} differs, {old['environment'].get(key)} vs {new['environment'].get(key)}")
+    rows, regressions = compare(old["results"], new["results"],
+                                compare_arg.threshold, compare_arg.min_seconds)
+    for id, before, after, ratio in rows:
+        flag = " <- regression" if id in regressions else ""
+        print(f"{id}: {before*1000:.3f} ms -> {after*1000:.3f} ms ({ratio:.2f}x){flag}")
+    only = sorted(set(old["results"]) ^ set(new["results"]))
+    if only:
+        print(f"{len(only)} cases are only in one of the files")
+    print(f"{len(regressions)} regressions")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import torch as t
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+import utils
+from channel import compute_power_coeff_batch, calculate_E_batch
+from partition import split_indices
+from DLLSOA import DLLSOA, LocalClient
+from model.resnet18 import Resnet18
+from model.CNN import CNN, SlimCNN
+from benchmarks.common import Skip, measure, case_id, environment
+
+# the models of the benchmarks and their model_name in the configuration
+MODELS = {"Resnet18": (lambda: Resnet18(1, 10), "resnet-18"),
+          "CNN": (lambda: CNN(1, 10), "CNN"),
+          "SlimCNN": (lambda: SlimCNN(1, 10), "CNN-slim")}
+
+
+def weight_keys(net: nn.Module) -> list[str]:
+    # the components which can be transmitted, see LocalClient.generate_mask
+    return [name for name, _ in net.named_parameters() if "weight" in name or "bias" in name]
+
+
+def mask_keys(net: nn.Module, ratio: float) -> list[str]:
+    # a fixed random mask with the given fraction of the components
+    keys = weight_keys(net)
+    num = max(1, int(round(ratio*len(keys))))
+    chosen = np.sort(np.random.default_rng(0).permutation(len(keys))[:num])
+    return [keys[idx] for idx in chosen]
+
+
+def model_bytes(net: nn.Module, keys: list[str] = None) -> int:
+    params = dict(net.named_parameters())
+    return sum(params[key].numel()*params[key].element_size() for key in (keys or params.keys()))
+
+
+def require(nbytes: float, budget: float):
+    # skip the cases whose working set exceeds the memory budget
+    if nbytes > budget:
+        raise Skip(f"needs {nbytes/2**30:.1f} GB, the budget is {budget/2**30:.1f} GB")
+
+
+def make_client(net: nn.Module, num_components: int) -> LocalClient:
+    return LocalClient(0, net, None, None, nn.CrossEntropyLoss(), "random", 1e-3, 1, num_components,
+                       t.device("cpu"), np.random.default_rng(0).rayleigh(1., size=(2, num_components)), True, "eq3")
+
+
+def bench_aggregation(model, clients, mask, repeat, budget):
+    """
+    utils.aggregation of the masked components sent by the neighbors of a receiver,
+    a receiver of gen_topo has clients / 2 neighbors on average
+    """
+    net = MODELS[model][0]()
+    keys = mask_keys(net, mask)
+    degree = max(1, clients//2)
+    require((degree+1)*model_bytes(net, keys), budget)
+    state = net.state_dict()
+    sent = [{key: state[key].clone() for key in keys} for _ in range(degree)]
+    # the first dict is updated in place
+    return measure(lambda dicts: utils.aggregation(dicts, 0.01),
+                   lambda: [{k: v.clone() for k, v in sent[0].items()}]+sent[1:], repeat)
+
+
+def bench_weight_norm(model, mask, repeat, budget):
+    """
+    calculate_weight_norm of the masked components
+    """
+    net = MODELS[model][0]()
+    keys = mask_keys(net, mask)
+    return measure(lambda: utils.calculate_weight_norm(net, keys), repeat=repeat)
+
+
+def bench_power_coeff(model, clients, mask, repeat, budget):
+    """
+    compute_power_coeff of all neighbors of a receiver, one pair at a time
+    """
+    net = MODELS[model][0]()
+    num = len(mask_keys(net, mask))
+    degree = max(1, clients//2)
+    rng = np.random.default_rng(0)
+    x = rng.random((degree, num))
+    h = rng.rayleigh(1., size=num)
+    W = rng.random(degree)
+
+    def fn():
+        for k in range(degree):
+            E = utils.calculate_E(W[k], x[k], h, 0.8)
+            utils.compute_power_coeff(E, W[k], h, x[k], True, "eq3")
+    return measure(fn, repeat=repeat)
+
+
+def bench_power_coeff_batch(model, clients, mask, repeat, budget):
+    """
+    compute_power_coeff_batch of all pairs of the network at once, as the flat engine does
+    """
+    net = MODELS[model][0]()
+    num = len(mask_keys(net, mask))
+    # x, h, b and the temporaries of [clients, clients, num] float64 arrays
+    require(6*8*clients*clients*num, budget)
+    rng = np.random.default_rng(0)
+    x = rng.random((clients, clients, num))
+    h = rng.rayleigh(1., size=(clients, 1, num))
+    W = rng.random((clients, clients))
+    beta = np.full((clients, clients), 0.8)
+
+    def fn():
+        E = calculate_E_batch(W, x, h, beta)
+        compute_power_coeff_batch(E, W, h, x, True, "eq3")
+    return measure(fn, repeat=repeat)
+
+
+def bench_topology(clients, repeat, budget):
+    """
+    gen_topo and init_w of the dense network
+    """
+    require(4*8*clients*clients, budget)
+    np.random.seed(0)
+    return measure(lambda: utils.init_w(utils.gen_topo(clients)), repeat=repeat)
+
+
+def bench_send_params(model, mask, repeat, budget):
+    """
+    LocalClient.send_params of the masked components, including the norms
+    """
+    net = MODELS[model][0]()
+    keys = mask_keys(net, mask)
+    client = make_client(net, len(keys))
+    np.random.seed(0)
+    # the norms are cached until the parameters change, every call starts after an update
+    return measure(lambda _: client.send_params(keys, 0.3, client.channel_gain[1], 0.8, 0.01),
+                   client.invalidate_norms, repeat)
+
+
+def bench_rcv_params(model, mask, repeat, budget):
+    """
+    LocalClient.rcv_params of the masked components with a precomputed alpha
+    """
+    net = MODELS[model][0]()
+    keys = mask_keys(net, mask)
+    client = make_client(net, len(keys))
+    received = {key: t.randn_like(client.components[key]) for key in keys}
+    return measure(lambda _: client.rcv_params(received, None, None, "eq5", 1., 0.5),
+                   lambda: None, repeat)
+
+
+def bench_split(scheme, clients, repeat, budget):
+    """
+    the split of 60000 samples of 10 labels among the clients
+    """
+    if scheme == "shard" and clients > 200:
+        raise Skip("the shard split has 200 shards")
+    labels = np.random.default_rng(0).integers(0, 10, 60000)
+    return measure(lambda: split_indices(labels, scheme, clients, 0, 200, 0.5), repeat=repeat)
+
+
+def bench_round(model, clients, mask, repeat, budget):
+    """
+    one communication round of DLLSOA.communicate, the local update is not included
+    """
+    make, model_name = MODELS[model]
+    net = make()
+    # the models, the receive buffers and the payloads
+    require((2*clients+2)*model_bytes(net), budget)
+    args = {"dataset": "MNIST", "model_name": model_name, "num_clients": clients, "sigma": 0.01,
+            "amendment_strategy": "eq5", "train_epoch": 1, "beta": 0.8, "pow_limit": True, "seed": 0,
+            "beta_noise": 0.01, "aggregation_mode": "dllsoa", "disable_com": False,
+            "sub_carrier_strategy": "no-limit", "comp_strategy": "random", "lr": 1e-3, "ep_num": 1,
+            "pow_allocation_strategy": "eq3", "cuda": False, "batch_size": 8, "iid": True}
+    # a few synthetic samples, the data is not used by the communication
+    loader = DataLoader(TensorDataset(t.randn(8, 1, 28, 28), t.randint(0, 10, (8,))), 8)
+    log_dir = tempfile.mkdtemp()
+    try:
+        np.random.seed(0)
+        m = DLLSOA(dict(args, log_dir=log_dir),
+                   ([loader]*clients, loader, loader, np.random.get_state()))
+    except Exception as e:
+        shutil.rmtree(log_dir, ignore_errors=True)
+        raise Skip(f"DLLSOA does not support {model}: {e}")
+    try:
+        num = len(mask_keys(net, mask))
+        for client in m.clients:
+            client.sub_carrier_num = num
+            client.channel_gain = client.channel_gain[:, :num]
+        m.init_weight(0)
+        return measure(m.communicate, repeat=repeat)
+    finally:
+        m.writer.close()
+        m.profiler.close()
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+def cases(models: list, clients: list, masks: list):
+    """
+    all cases of the suite
+    ------
+    Returns:
+        the list of (id, benchmark, parameters)
+    """
+    result = []
+    for model in models:
+        for mask in masks:
+            result.append((case_id("weight_norm", model=model, mask=mask),
+                           bench_weight_norm, dict(model=model, mask=mask)))
+            result.append((case_id("send_params", model=model, mask=mask),
+                           bench_send_params, dict(model=model, mask=mask)))
+            result.append((case_id("rcv_params", model=model, mask=mask),
+                           bench_rcv_params, dict(model=model, mask=mask)))
+            for n in clients:
+                params = dict(model=model, clients=n, mask=mask)
+                result.append((case_id("aggregation", **params),
+                               bench_aggregation, params))
+                result.append((case_id("power_coeff", **params),
+                               bench_power_coeff, params))
+                result.append((case_id("power_coeff_batch", **params),
+                               bench_power_coeff_batch, params))
+                result.append((case_id("round", **params),
+                               bench_round, params))
+    for n in clients:
+        result.append((case_id("topology", clients=n),
+                       bench_topology, dict(clients=n)))
+        for scheme in ("iid", "shard", "dirichlet"):
+            result.append((case_id("split", scheme=scheme, clients=n),
+                           bench_split, dict(scheme=scheme, clients=n)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmark_DLLSOA", description="run the microbenchmarks of the hot paths on the cpu"
+    )
+    parser.add_argument("--clients", type=int, nargs="+", default=[12, 100, 1000],
+                        help="the numbers of clients")
+    parser.add_argument("--models", type=str, nargs="+", default=list(MODELS.keys()),
+                        help="the models, only support Resnet18, CNN and SlimCNN")
+    parser.add_argument("--masks", type=float, nargs="+", default=[0.25, 0.5, 1.0],
+                        help="the fractions of the transmitted components")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="the number of timed calls of every case")
+    parser.add_argument("--max-memory", type=float, default=4.,
+                        help="the memory budget of a case in GB, the larger cases are skipped")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="the intra-op thread number, fix it to compare the results of two commits")
+    parser.add_argument("--filter", type=str, default=None,
+                        help="only run the cases whose id contains the string")
+    parser.add_argument("--output", type=str, default="benchmarks/results.json",
+                        help="the json file of the results")
+    bench_arg = parser.parse_args()
+    if bench_arg.threads is not None:
+        t.set_num_threads(bench_arg.threads)
+    for model in bench_arg.models:
+        if model not in MODELS:
+            raise ValueError("only support Resnet18, CNN and SlimCNN")
+    budget = bench_arg.max_memory*2**30
+    results = {}
+    for id, bench, params in cases(bench_arg.models, bench_arg.clients, bench_arg.masks):
+        if bench_arg.filter is not None and bench_arg.filter not in id:
+            continue
+        try:
+            results[id] = bench(repeat=bench_arg.repeat,
+                                budget=budget, **params)
+            print(f"{id}: {results[id]['median']*1000:.3f} ms")
+        except Skip as e:
+            results[id] = {"skipped": str(e)}
+            print(f"{id}: skipped, {e}")
+    folder = os.path.dirname(bench_arg.output)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(bench_arg.output, "w") as f:
+        json.dump({"environment": environment(),
+                   "config": {"clients": bench_arg.clients, "models": bench_arg.models,
+                              "masks": bench_arg.masks, "repeat": bench_arg.repeat,
+                              "max_memory": bench_arg.max_memory},
+                   "results": results}, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import numpy as np
+import torch as t
+from numpy import ndarray
+
+
+def calculate_E_batch(W: ndarray, x: ndarray, h: ndarray, beta: ndarray):
+    """
+    Calculate E_{ij} of many device pairs at once, the batched version of calculate_E
+    ------
+    Parameters:
+        W: [...], the weights of the device pairs
+        x: [..., K], the l2 norm of the model components, padded with 0
+        h: [..., K], the channel gains of the device pairs, padded with 1
+        beta: [...], the estimation factors
+    Returns:
+        [...], the estimated E_{ij}
+    """
+    inner_term = np.expand_dims(W, -1) * x / h
+    inner_term = np.power(inner_term, 2)
+    inner_term = np.sum(inner_term, axis=-1)
+    return inner_term*beta
+
+
+def compute_power_coeff_batch(E: ndarray, W: ndarray, h: ndarray, x: ndarray, pow_limit: bool, pow_allow_stg: str):
+    """
+    compute the power allocation coefficients of many device pairs at once,
+    the batched version of compute_power_coeff
+    ------
+    Parameters:
+        E: [...], the E_{ij} in equation (3)
+        W: [...], the W_{ij} in equation (3)
+        h: [..., K], the channel gains of the device pairs, padded with 1
+        x: [..., K], the component of each sub_carrier, padded with 0
+        pow_limit: whether the transmition power is limited
+        pow_allow_stg: the power allocation strategy when power_limit is True, only support avg and eq3
+    Returns:
+        ndarray: [..., K], the power allocation coefficients of all channels
+        ndarray: [...], xi
+    """
+    # first, calculate \xi^* according to equation (3)
+    denominator = W**2 * np.sum(np.power(x, 2)/np.power(h, 2), axis=-1)
+    xi = np.sqrt(np.divide(E, denominator, out=np.zeros_like(denominator),
+                           where=denominator != 0.))
+    # second, caculate the b_{ij}^*(k)
+    W = np.expand_dims(W, -1)
+    if pow_limit:
+        if pow_allow_stg == "eq3":
+            b = np.expand_dims(xi, -1)*W/h
+        elif pow_allow_stg == "avg":
+            b = np.sqrt(E/np.sum(np.power(x, 2), axis=-1))
+            b = np.expand_dims(b, -1)*np.ones_like(h)
+        else:
+            raise ValueError(
+                "the power allocation coefficient only supports avg and eq3")
+    else:
+        b = W/h
+    return b, xi
+
+
+def compute_alpha_batch(ids: ndarray, xi_neighbors: ndarray, weight_neighbors: ndarray = None, pow_limit=False):
+    """
+    compute alpha_i of many clients at once, the batched version of compute_alpha
+    ------
+    Parameters:
+        ids: [m], the ids of the clients
+        xi_neighbors: [m, n], the xi of the neighbors of each client
+        weight_neighbors: [m, n], the weight of the neighbors of each client
+        pow_limit: whether the transmition power is limited
+    Returns:
+        [m], the estimated alpha, if weight_neighbors is None, use equation (5) else use equation (6)
+    """
+    ids = np.asarray(ids)
+    rows = np.arange(len(ids))
+    if not pow_limit:
+        return np.ones(len(ids))
+    xi_neighbors = xi_neighbors.copy()
+    xi_neighbors[rows, ids] = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # if weight_neighbors is none, use equation (5)
+        if weight_neighbors is None:
+            return np.count_nonzero(xi_neighbors, axis=1)/np.sum(xi_neighbors, axis=1)
+        # else use equation (6)
+        weight_neighbors = weight_neighbors.copy()
+        weight_neighbors[rows, ids] = 0
+        return np.sum(weight_neighbors, axis=1)/np.sum(weight_neighbors*xi_neighbors, axis=1)
+
+
+def compute_alpha_neighbors(xi_neighbors: ndarray, weight_neighbors: ndarray = None, pow_limit=False):
+    """
+    compute alpha_i from the xi of the current neighbors only, it is the same as compute_alpha
+    except that the xi of the former neighbors are not kept
+    ------
+    Parameters:
+        xi_neighbors: the xi of the neighbors, without client i itself
+        weight_neighbors: the weight of the neighbors, without client i itself
+        pow_limit: whether the transmition power is limited
+    Returns:
+        the estimated alpha, if weight_neighbors is None, use equation (5) else use equation (6)
+    """
+    if not pow_limit:
+        return 1.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if weight_neighbors is None:
+            return np.count_nonzero(xi_neighbors)/np.sum(xi_neighbors)
+        return np.sum(weight_neighbors)/np.sum(weight_neighbors*xi_neighbors)
+
+
+def calculate_agg_var_batch(W: ndarray, sigma: float, agg_mode: str):
+    """
+    Calculate the variance of Gaussian noise of all clients at once,
+    the batched version of calculate_agg_var
+    ------
+    Parameters:
+        W: the weight matrix
+        sigma: the orginal variance
+        agg_mode: the aggregation mode, only support dllsoa and dpsgd
+    Returns:
+        [n], the variance of Gaussian noise in aggregation procedure of each client
+    """
+    if agg_mode == "dllsoa":
+        return np.full(W.shape[0], sigma, dtype=np.float64)
+    elif agg_mode == "dpsgd":
+        w_prime = W - np.diag(np.diagonal(W))
+        return sigma * np.linalg.norm(w_prime, axis=1)
+    else:
+        raise NotImplementedError("Only support dllsoa and dpsgd")
+
+
+def calculate_agg_var_graph(graph, sigma: float, agg_mode: str):
+    """
+    Calculate the variance of Gaussian noise of all clients from the weighted graph,
+    the same as calculate_agg_var_batch without the dense weight matrix
+    ------
+    Parameters:
+        graph: the topology.Graph with weights
+        sigma: the orginal variance
+        agg_mode: the aggregation mode, only support dllsoa and dpsgd
+    Returns:
+        [n], the variance of Gaussian noise in aggregation procedure of each client
+    """
+    if agg_mode == "dllsoa":
+        return np.full(graph.num_nodes, sigma, dtype=np.float64)
+    elif agg_mode == "dpsgd":
+        return sigma * graph.weight_norms()
+    else:
+        raise NotImplementedError("Only support dllsoa and dpsgd")
+
+
+class OTAAccumulator(object):
+    """
+    The receive buffers of the over-the-air aggregation. Every sender adds its scaled
+    components directly into the preallocated buffers while it transmits, and the
+    noise is added once at the end, so the memory is O(model) regardless of the degree.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.supports = {}
+        self.scratch = {}
+        self.begin()
+
+    def begin(self):
+        """
+        start a new reception
+        """
+        self.keys = []
+        self.sparse_keys = []
+        self.data_size = 0
+        self.data_amount = 0
+
+    def add(self, key: str, tensor: t.Tensor, scale: float):
+        """
+        add the scaled component of a sender to the receive buffer
+        ------
+        Parameters:
+            key: the name of the component
+            tensor: the component
+            scale: the power allocation coefficient times the channel gain
+        """
+        with t.no_grad():
+            if key not in self.keys:
+                buffer = self.buffers.get(key)
+                if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype or buffer.device != tensor.device:
+                    buffer = self.buffers[key] = t.empty_like(
+                        tensor, memory_format=t.contiguous_format)
+                t.mul(tensor, scale, out=buffer)
+                self.keys.append(key)
+            else:
+                self.buffers[key].add_(tensor, alpha=scale)
+        # tally the communication data amount
+        self.data_size += tensor.nelement()*tensor.element_size()
+        self.data_amount += tensor.nelement()
+
+    def add_encoded(self, key: str, payload: tuple, scale: float, codec, resend_base: bool = False):
+        """
+        decode the payload of a sender into the receive buffer
+        ------
+        Parameters:
+            key: the name of the component
+            payload: the encoded component, see codec.PayloadCodec
+            scale: the power allocation coefficient times the channel gain
+            codec: the codec of the payload
+            resend_base: the receiver has missed the last payload, so the base is sent again in fp32
+        """
+        codes = payload[0]
+        with t.no_grad():
+            if key not in self.keys:
+                buffer = self.buffers.get(key)
+                if buffer is None or buffer.shape != codes.shape or buffer.device != codes.device:
+                    buffer = self.buffers[key] = t.empty(
+                        codes.shape, device=codes.device)
+                buffer.zero_()
+                self.keys.append(key)
+            codec.decode_into(self.buffers[key], payload, scale)
+        # tally the encoded size
+        self.data_size += codec.nbytes(payload)
+        self.data_amount += codes.nelement()
+        if resend_base:
+            self.add_resend(payload[2])
+
+    def add_resend(self, tensor: t.Tensor):
+        """
+        tally a tensor which the receiver has missed and gets again without the over-the-air
+        aggregation, e.g. the base of the delta encoding or the reference copy of topk and randk
+        """
+        self.data_size += tensor.nelement()*tensor.element_size()
+        self.data_amount += tensor.nelement()
+
+    def add_sparse(self, key: str, numel: int, indices: t.Tensor, values: t.Tensor, index_size: int = 0):
+        """
+        add a scaled sparse payload to a flat receive buffer
+        ------
+        Parameters:
+            key: the name of the payload
+            numel: the length of the flat buffer
+            indices: the indices of the elements
+            values: the scaled values of the elements
+            index_size: the bytes of every index, 0 if the receiver regenerates the indices
+        """
+        with t.no_grad():
+            if key not in self.keys:
+                buffer = self.buffers.get(key)
+                if buffer is None or buffer.numel() != numel or buffer.dtype != values.dtype or buffer.device != values.device:
+                    buffer = self.buffers[key] = t.empty(
+                        numel, dtype=values.dtype, device=values.device)
+                    self.supports[key] = t.empty(
+                        numel, dtype=t.bool, device=values.device)
+                buffer.zero_()
+                self.supports[key].zero_()
+                self.keys.append(key)
+                self.sparse_keys.append(key)
+            self.buffers[key].index_add_(0, indices, values)
+            # the noise is only added to the received elements
+            self.supports[key][indices] = True
+        # tally the communication data amount, including the indices
+        self.data_size += values.nelement()*values.element_size() + \
+            indices.nelement()*index_size
+        self.data_amount += values.nelement() + \
+            (indices.nelement() if index_size else 0)
+
+    def finish(self, sigma: float):
+        """
+        add the noise of the channel to the received signal
+        ------
+        Parameters:
+            sigma: the variance of the Gaussian noise
+        Returns:
+            the received components, None if no neighbor has transmitted
+        """
+        if len(self.keys) == 0:
+            return None
+        with t.no_grad():
+            for key in self.keys:
+                buffer = self.buffers[key]
+                if key in self.sparse_keys:
+                    indices = self.supports[key].nonzero().squeeze(1)
+                    buffer.index_add_(
+                        0, indices, self._noise(buffer[indices]), alpha=sigma)
+                else:
+                    buffer.add_(self._noise(buffer), alpha=sigma)
+        return {key: self.buffers[key] for key in self.keys}
+
+    def _noise(self, buffer: t.Tensor):
+        # standard Gaussian noise in a reused scratch buffer
+        scratch = self.scratch.get((buffer.dtype, buffer.device))
+        if scratch is None or scratch.numel() < buffer.numel():
+            scratch = self.scratch[(buffer.dtype, buffer.device)] = t.empty(
+                buffer.numel(), dtype=buffer.dtype, device=buffer.device)
+        return scratch[:buffer.numel()].view_as(buffer).normal_()
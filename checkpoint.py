@@ -0,0 +1,295 @@
+import os
+import random
+import inspect
+import numpy as np
+import torch as t
+from torch import Tensor
+from concurrent.futures import ThreadPoolExecutor
+from dataset import augment_generators
+
+
+def flatten(tensors: list[list[Tensor]]) -> Tensor:
+    """
+    concatenate the tensors of every client into a row of a [num_clients, total] buffer
+    ------
+    Parameters:
+        tensors: the tensors of every client, every client has the same shapes
+    Returns:
+        the flat buffer on the cpu
+    """
+    with t.no_grad():
+        return t.stack([t.cat([tensor.detach().reshape(-1).cpu() for tensor in row])
+                        if len(row) != 0 else t.zeros(0) for row in tensors])
+
+
+def unflatten_into(flat: Tensor, tensors: list[list[Tensor]]):
+    """
+    copy the rows of the flat buffer back to the tensors of every client
+    ------
+    Parameters:
+        flat: the [num_clients, total] buffer
+        tensors: the tensors of every client
+    """
+    with t.no_grad():
+        for row, client_tensors in zip(flat, tensors):
+            offset = 0
+            for tensor in client_tensors:
+                tensor.copy_(row[offset:offset+tensor.numel()].view_as(tensor))
+                offset += tensor.numel()
+
+
+def _rng_state(model) -> dict:
+    # the random states of the main process, the worker processes are added by the caller
+    generators = _augment_generators(model)
+    return {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": t.get_rng_state(),
+        "cuda": t.cuda.get_rng_state_all() if t.cuda.is_available() else None,
+        "topology": model.topo_rng.bit_generator.state,
+        "codec": model.codec.generator.get_state() if model.codec is not None else None,
+        "augment": [generator.get_state() for generator in generators],
+    }
+
+
+def _augment_generators(model) -> list:
+    # the generators of the batched augmentations, shared by the loaders
+    return augment_generators([client.train_loader for client in model.clients])
+
+
+def _optimizer_state(model, worker_state: dict):
+    # the Adam moments of every client as flat buffers
+    if model.optimizer is not None:
+        # the flat engine already keeps them in [num_clients, num_params] tensors
+        return {"exp_avg": model.optimizer.exp_avg.cpu().clone(),
+                "exp_avg_sq": model.optimizer.exp_avg_sq.cpu().clone(),
+                "steps": model.optimizer.steps.cpu().clone()}
+    exp_avg, exp_avg_sq, steps = [], [], []
+    for client in model.clients:
+        # the optimizers of the worker pool live in the worker processes
+        state_dict = worker_state[client.id] if worker_state is not None else client.optimizer.state_dict()
+        params = list(client.model.parameters())
+        state = [state_dict["state"].get(idx, {}) for idx in range(len(params))]
+        exp_avg.append([s.get("exp_avg", t.zeros_like(p))
+                        for s, p in zip(state, params)])
+        exp_avg_sq.append([s.get("exp_avg_sq", t.zeros_like(p))
+                           for s, p in zip(state, params)])
+        steps.append([t.as_tensor(s.get("step", 0.), dtype=t.float32)
+                      for s in state])
+    return {"exp_avg": flatten(exp_avg), "exp_avg_sq": flatten(exp_avg_sq), "steps": flatten(steps)}
+
+
+def capture_state(model, round: int) -> dict:
+    """
+    take a snapshot of the whole simulation, the tensors are copied so that the
+    training can continue while the snapshot is written
+    ------
+    Parameters:
+        model: the DLLSOA instance
+        round: the index of the next training round
+    Returns:
+        the snapshot
+    """
+    worker_rng, worker_optimizers = model.pool.get_state(
+    ) if model.pool is not None else (None, None)
+    float_tensors, int_tensors = [], []
+    for client in model.clients:
+        float_tensors.append([v for v in client.components.values() if v.is_floating_point()])
+        int_tensors.append([v for v in client.components.values() if not v.is_floating_point()])
+    state = {
+        "round": round,
+        "floats": flatten(float_tensors),
+        "ints": flatten(int_tensors),
+        "optimizer": _optimizer_state(model, worker_optimizers),
+        "sub_carrier_nums": [client.sub_carrier_num for client in model.clients],
+        "channel_gains": [client.channel_gain.copy() for client in model.clients],
+        "xi": None if model.xi is None else model.xi.copy(),
+        "rng": _rng_state(model),
+        "worker_rng": worker_rng,
+    }
+    # the gradients of the last local update, the grad strategy ranks them in the next communication
+    if model.engine is None and model.comp_strategy == "grad":
+        state["grads"] = flatten([[param.grad if param.grad is not None else t.zeros_like(param)
+                                   for param in client.model.parameters()]
+                                  for client in model.clients])
+    # the reference copies of topk and randk
+    if model.clients[0].reference is not None:
+        state["reference"] = t.stack(
+            [client.reference.cpu().clone() for client in model.clients])
+        state["reference_holders"] = [None if client.reference_holders is None else sorted(client.reference_holders)
+                                      for client in model.clients]
+    # the values known by the receivers of the delta encoding
+    if model.codec is not None and model.codec.delta:
+        names = [name for name, _ in model.clients[0].model.named_parameters()]
+        state["sent_mask"] = t.tensor([[name in client.sent for name in names]
+                                       for client in model.clients])
+        state["sent"] = flatten([[client.sent[name] if name in client.sent else t.zeros_like(param)
+                                  for name, param in client.model.named_parameters()]
+                                 for client in model.clients])
+        state["holders"] = [{key: sorted(receivers) for key, receivers in client.holders.items()}
+                            for client in model.clients]
+    return state
+
+
+def restore_clients(model, state: dict):
+    """
+    restore the models, the gradients, the optimizers and the sender states of the clients
+    ------
+    Parameters:
+        model: the DLLSOA instance, created with the same configuration
+        state: the snapshot of capture_state
+    """
+    unflatten_into(state["floats"], [[v for v in client.components.values() if v.is_floating_point()]
+                                     for client in model.clients])
+    unflatten_into(state["ints"], [[v for v in client.components.values() if not v.is_floating_point()]
+                                   for client in model.clients])
+    optimizer = state["optimizer"]
+    if model.optimizer is not None:
+        model.optimizer.exp_avg.copy_(optimizer["exp_avg"])
+        model.optimizer.exp_avg_sq.copy_(optimizer["exp_avg_sq"])
+        model.optimizer.steps.copy_(optimizer["steps"])
+    else:
+        for i, client in enumerate(model.clients):
+            params = list(client.model.parameters())
+            exp_avg = [t.zeros_like(p) for p in params]
+            exp_avg_sq = [t.zeros_like(p) for p in params]
+            unflatten_into(optimizer["exp_avg"][i:i+1], [exp_avg])
+            unflatten_into(optimizer["exp_avg_sq"][i:i+1], [exp_avg_sq])
+            steps = optimizer["steps"][i]
+            state_dict = client.optimizer.state_dict()
+            # the parameters which have never been updated have no state
+            state_dict["state"] = {idx: {"step": steps[idx].clone(), "exp_avg": exp_avg[idx], "exp_avg_sq": exp_avg_sq[idx]}
+                                   for idx in range(len(params)) if steps[idx] > 0}
+            client.optimizer.load_state_dict(state_dict)
+    if "grads" in state and model.engine is None:
+        for client in model.clients:
+            for param in client.model.parameters():
+                if param.grad is None:
+                    param.grad = t.zeros_like(param)
+        unflatten_into(state["grads"], [[param.grad for param in client.model.parameters()]
+                                        for client in model.clients])
+    if "reference" in state and model.clients[0].reference is not None:
+        for client, reference in zip(model.clients, state["reference"]):
+            client.reference.copy_(reference)
+        # the older checkpoints assume that every client knows the reference copies
+        for client, holders in zip(model.clients, state.get("reference_holders", [None for _ in model.clients])):
+            client.reference_holders = None if holders is None else set(holders)
+            client.receivers = set()
+    if "sent" in state:
+        names = [name for name, _ in model.clients[0].model.named_parameters()]
+        for client, row, mask in zip(model.clients, state["sent"], state["sent_mask"]):
+            offset = 0
+            client.sent = {}
+            for k, (name, param) in enumerate(zip(names, client.model.parameters())):
+                if mask[k]:
+                    client.sent[name] = row[offset:offset+param.numel()].view_as(
+                        param).to(param.device).clone()
+                offset += param.numel()
+        # the older checkpoints have no receivers, the bases are resent once
+        for client, holders in zip(model.clients, state.get("holders", [{} for _ in model.clients])):
+            client.holders = {key: set(receivers)
+                              for key, receivers in holders.items()}
+            client.base_holders = {}
+    for client in model.clients:
+        client.encoded = {}
+        client.invalidate_norms()
+
+
+def restore_torch_rng(model, state: dict):
+    """
+    restore the random states used by the local update phase, i.e. torch, the batched
+    augmentation and the worker processes
+    ------
+    Parameters:
+        model: the DLLSOA instance
+        state: the snapshot of capture_state
+    """
+    rng = state["rng"]
+    t.set_rng_state(rng["torch"])
+    if rng["cuda"] is not None and t.cuda.is_available():
+        t.cuda.set_rng_state_all(rng["cuda"])
+    for generator, generator_state in zip(_augment_generators(model), rng["augment"]):
+        generator.set_state(generator_state)
+    model.worker_rng = state["worker_rng"]
+
+
+def restore_state(model, state: dict):
+    """
+    restore the snapshot of capture_state
+    ------
+    Parameters:
+        model: the DLLSOA instance, created with the same configuration
+        state: the snapshot
+    Returns:
+        the index of the next training round
+    """
+    restore_clients(model, state)
+    for client, num, gain in zip(model.clients, state["sub_carrier_nums"], state["channel_gains"]):
+        client.sub_carrier_num = num
+        client.channel_gain = gain
+    if state["xi"] is not None:
+        model.xi = state["xi"].copy()
+    # the random states
+    rng = state["rng"]
+    random.setstate(rng["random"])
+    np.random.set_state(rng["numpy"])
+    model.topo_rng.bit_generator.state = rng["topology"]
+    if rng["codec"] is not None:
+        model.codec.generator.set_state(rng["codec"])
+    restore_torch_rng(model, state)
+    return state["round"]
+
+
+def save_checkpoint(state: dict, path: str):
+    """
+    write a snapshot to a single file, the former checkpoint is only replaced
+    once the new one is complete
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    t.save(state, path+".tmp")
+    os.replace(path+".tmp", path)
+
+
+def load_checkpoint(path: str) -> dict:
+    """
+    read a snapshot written by save_checkpoint
+    """
+    # the snapshot contains the random states of python and numpy
+    if "weights_only" in inspect.signature(t.load).parameters:
+        return t.load(path, map_location="cpu", weights_only=False)
+    # torch<1.13 always unpickles the whole file
+    return t.load(path, map_location="cpu")
+
+
+class CheckpointWriter(object):
+    """
+    Write the checkpoints in a background thread, at most one checkpoint is being written
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, state: dict, path: str):
+        """
+        write the snapshot asynchronously, wait for the former one first
+        """
+        self.wait()
+        self.pending = self.executor.submit(save_checkpoint, state, path)
+
+    def wait(self):
+        """
+        wait for the pending checkpoint, the exceptions of the writer are raised here
+        """
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        """
+        wait for the pending checkpoint and stop the background thread
+        """
+        self.wait()
+        self.executor.shutdown(wait=True)
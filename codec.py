@@ -0,0 +1,91 @@
+import math
+import torch as t
+from torch import Tensor
+
+
+class PayloadCodec(object):
+    """
+    The encoding of the transmitted components. A payload is a tuple (codes, step, base):
+    the codes are the cast or quantized values, step is the per-tensor scale of the quantized
+    codes (None for the casts), and base is the value of the last round which the codes are
+    relative to (None without delta encoding). The decoding is fused into the accumulation
+    of the receiver, the decoded tensor is never materialized. The base is assumed to be known
+    by the receiver: the sender tracks the receivers of its last payload and resends the base
+    in fp32 to the others, e.g. after the topology or the mask has changed. nbytes only counts
+    the codes, the resent base is tallied by the receive buffers, see OTAAccumulator.add_encoded.
+    """
+
+    def __init__(self, mode: str = "none", delta: bool = False, seed: int = None):
+        """
+        Parameters:
+        -------
+        mode: only support none, fp16, bf16, int8 and int4, the integer modes use stochastic rounding
+        delta: encode the difference between the component and its value of the last round
+        seed: the seed of the stochastic rounding
+        """
+        if mode not in ("none", "fp16", "bf16", "int8", "int4"):
+            raise ValueError("only support none, fp16, bf16, int8 and int4")
+        self.mode = mode
+        self.delta = delta
+        self.bits = {"none": 32, "fp16": 16, "bf16": 16,
+                     "int8": 8, "int4": 4}[mode]
+        self.generator = t.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+    def encode(self, tensor: Tensor, base: Tensor = None):
+        """
+        encode a tensor
+        ------
+        Parameters:
+            tensor: the tensor to send, the difference to base if delta encoding is used
+            base: the value of the last round known by the receivers
+        Returns:
+            the payload (codes, step, base)
+        """
+        with t.no_grad():
+            if self.mode == "none":
+                return tensor.clone(), None, base
+            elif self.mode == "fp16":
+                return tensor.half(), None, base
+            elif self.mode == "bf16":
+                return tensor.bfloat16(), None, base
+            # the 4-bit codes are kept in int8 tensors, the reported size is the packed size
+            levels = 2**(self.bits-1)-1
+            step = tensor.abs().max().item()/levels
+            if step == 0.:
+                return t.zeros_like(tensor, dtype=t.int8), 0., base
+            noise = t.rand(tensor.shape, generator=self.generator).to(
+                tensor.device)
+            codes = tensor.div(step).add_(noise).floor_().clamp_(-levels, levels)
+            return codes.to(t.int8), step, base
+
+    def decode_into(self, buffer: Tensor, payload: tuple, scale: float):
+        """
+        add the scaled decoded payload to the receive buffer, buffer += scale*decode(payload)
+        ------
+        Parameters:
+            buffer: the receive buffer
+            payload: the payload (codes, step, base)
+            scale: the power allocation coefficient times the channel gain
+        """
+        codes, step, base = payload
+        with t.no_grad():
+            if base is not None:
+                buffer.add_(base, alpha=scale)
+            buffer.add_(codes, alpha=scale if step is None else scale*step)
+
+    def decode(self, payload: tuple) -> Tensor:
+        """
+        decode a payload, it is used by the sender to track the value known by the receivers
+        """
+        codes, step, base = payload
+        value = codes.float() if step is None else codes.float().mul_(step)
+        return value if base is None else value.add_(base)
+
+    def nbytes(self, payload: tuple) -> int:
+        """
+        the encoded size of a payload in bytes, including the per-tensor scale
+        """
+        codes, step, _ = payload
+        return math.ceil(codes.nelement()*self.bits/8) + (0 if step is None else 4)
@@ -1,26 +1,204 @@
 import torchvision as tv
-
-from torch.utils import data
+import os
+import torch as t
 import numpy as np
 from torch.utils.data import DataLoader, Dataset
 import torchvision.transforms as transforms
+from partition import partition
 
 
 class DatasetSplit(Dataset):
     def __init__(self, dataset, idxs):
         super().__init__()
         self.dataset = dataset
-        self.idxs = list(idxs)
+        self.idxs = np.asarray(idxs, dtype=np.int64)
 
     def __len__(self):
         return len(self.idxs)
 
     def __getitem__(self, item):
-        image, label = self.dataset[self.idxs[item]]
+        image, label = self.dataset[int(self.idxs[item])]
         return image, label
 
 
-def load_mnist(iid: bool, num_users: int, batch_size: int):
+class ArrayDataset(Dataset):
+    """
+    The subset of a decoded uint8 image array, the samples are normalized in batches by ArrayLoader
+    """
+
+    def __init__(self, images: np.ndarray, labels: np.ndarray, idxs, mean: tuple, std: tuple):
+        """
+        Parameters:
+        -------
+        images: [N, C, H, W] uint8 array, usually memory-mapped
+        labels: [N] int64 array
+        idxs: the indices of the subset
+        mean: the mean of each channel
+        std: the std of each channel
+        """
+        super().__init__()
+        self.images = images
+        self.labels = labels
+        self.targets = t.from_numpy(labels)
+        self.idxs = np.fromiter(idxs, dtype=np.int64, count=len(idxs))
+        self.mean = t.tensor(mean).view(1, -1, 1, 1)
+        self.std = t.tensor(std).view(1, -1, 1, 1)
+
+    def __len__(self):
+        return len(self.idxs)
+
+    def __getitem__(self, item):
+        X, y = self.get_batch(self.idxs[[item]])
+        return X[0], y[0]
+
+    def get_batch(self, idxs: np.ndarray, augment=None):
+        """
+        read a batch by fancy-indexing the arrays and normalize it in a single vectorized op
+        ------
+        Parameters:
+            idxs: the indices of the samples in the whole dataset
+            augment: the batched augmentation applied to the uint8 images
+        Returns:
+            the normalized images and the labels
+        """
+        X = t.from_numpy(np.ascontiguousarray(self.images[idxs]))
+        if augment is not None:
+            X = augment(X)
+        X = X.float().div_(255).sub_(self.mean).div_(self.std)
+        y = t.from_numpy(self.labels[idxs])
+        return X, y
+
+
+class ArrayLoader(object):
+    """
+    Serve whole batches of an ArrayDataset, it has the same interface as DataLoader
+    """
+
+    def __init__(self, dataset: ArrayDataset, batch_size: int, shuffle: bool, augment=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+
+    def __len__(self):
+        return (len(self.dataset)+self.batch_size-1)//self.batch_size
+
+    def __iter__(self):
+        idxs = self.dataset.idxs
+        if self.shuffle:
+            idxs = idxs[t.randperm(len(idxs)).numpy()]
+        for start in range(0, len(idxs), self.batch_size):
+            # sorted indices make the reads of the memory-mapped file sequential
+            yield self.dataset.get_batch(np.sort(idxs[start:start+self.batch_size]), self.augment)
+
+
+class BatchRandomCropFlip(object):
+    """
+    The batched version of RandomCrop(size, padding) followed by RandomHorizontalFlip(),
+    the crops of a whole [B, C, H, W] batch are gathered at once and the flips are
+    folded into the gathered column indices.
+    """
+
+    def __init__(self, padding: int = 4, seed: int = None, fill=0):
+        """
+        Parameters:
+        -------
+        padding: the padding of each border
+        seed: the seed of the random crops and flips, None means a random seed
+        fill: the value of the padded pixels, a number or a value of each channel
+        """
+        self.padding = padding
+        self.fill = fill
+        self.generator = t.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def __call__(self, X: t.Tensor) -> t.Tensor:
+        B, C, H, W = X.shape
+        p = self.padding
+        padded = X.new_empty(B, C, H+2*p, W+2*p)
+        padded[:] = t.as_tensor(self.fill, dtype=X.dtype).view(1, -1, 1, 1)
+        padded[:, :, p:p+H, p:p+W] = X
+        # the offsets of the crops and the flip mask
+        top = t.randint(0, 2*p+1, (B,), generator=self.generator)
+        left = t.randint(0, 2*p+1, (B,), generator=self.generator)
+        flip = t.rand(B, generator=self.generator) < 0.5
+        rows = top.unsqueeze(1)+t.arange(H)
+        cols = t.arange(W).expand(B, W)
+        cols = t.where(flip.unsqueeze(1), W-1-cols, cols)+left.unsqueeze(1)
+        return padded[t.arange(B).view(B, 1, 1, 1),
+                      t.arange(C).view(1, C, 1, 1),
+                      rows.view(B, 1, H, 1),
+                      cols.view(B, 1, 1, W)]
+
+
+def augment_generators(loaders: list) -> list:
+    """
+    the generators of the batched augmentations of the loaders, a generator shared by
+    several loaders is listed once
+    """
+    generators = []
+    for loader in loaders:
+        augment = getattr(loader, "augment", None)
+        generator = getattr(augment, "generator", None)
+        if generator is not None and all(generator is not g for g in generators):
+            generators.append(generator)
+    return generators
+
+
+class AugmentedLoader(object):
+    """
+    Apply a batched augmentation to the batches of a DataLoader
+    """
+
+    def __init__(self, loader: DataLoader, augment):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for (X, y) in self.loader:
+            yield self.augment(X), y
+
+
+def cache_arrays(name: str, load_dataset, root: str = r'data'):
+    """
+    decode the dataset once into uint8 .npy files and memory-map them
+    ------
+    Parameters:
+        name: the name of the cache files
+        load_dataset: a callable which returns the torchvision dataset, only called if the cache does not exist
+        root: the root of the datasets
+    Returns:
+        the memory-mapped [N, C, H, W] images and the labels
+    """
+    folder = os.path.join(root, "cache")
+    image_path = os.path.join(folder, f"{name}_images.npy")
+    label_path = os.path.join(folder, f"{name}_labels.npy")
+    if not (os.path.exists(image_path) and os.path.exists(label_path)):
+        os.makedirs(folder, exist_ok=True)
+        dataset = load_dataset()
+        images = np.asarray(dataset.data, dtype=np.uint8)
+        if images.ndim == 3:
+            images = images[:, None]
+        else:
+            images = images.transpose(0, 3, 1, 2)
+        labels = np.asarray(dataset.targets, dtype=np.int64)
+        # write to a temporary file of this process first so that a concurrent run never reads a partial cache
+        for path, array in ((image_path, images), (label_path, labels)):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
+    return np.load(image_path, mmap_mode="r"), np.load(label_path)
+
+
+def load_mnist(iid: bool, num_users: int, batch_size: int, backend: str = "torchvision", seed: int = None, scheme: str = None, alpha: float = 0.5):
     """
     Load the MNIST dataset
     -------
@@ -32,6 +210,14 @@ def load_mnist(iid: bool, num_users: int, batch_size: int):
         the number of users
     batch_size: int
         the batch size
+    backend: str
+        torchvision or memmap, memmap serves batches from the decoded uint8 arrays
+    seed: int
+        the seed of the split, the split is cached in data/cache/partitions
+    scheme: str
+        iid, shard or dirichlet, None means iid if iid is True else shard
+    alpha: float
+        the concentration of the dirichlet split
     Returns:
     --------
     list[DataLoader]:
@@ -39,20 +225,35 @@ def load_mnist(iid: bool, num_users: int, batch_size: int):
     Dataset
         the whole train and test dataset
     """
+    if backend == "memmap":
+        mean, std = (0.1307,), (0.3081,)
+        images, labels = cache_arrays("mnist_train", lambda: tv.datasets.MNIST(
+            root=r'data', train=True, download=True))
+        dataset_train = ArrayDataset(
+            images, labels, np.arange(len(labels)), mean, std)
+        images, labels = cache_arrays("mnist_test", lambda: tv.datasets.MNIST(
+            root=r'data', train=False, download=True))
+        dataset_test = ArrayDataset(
+            images, labels, np.arange(len(labels)), mean, std)
+        # 200 shards of 300 samples
+        users = partition("mnist", dataset_train.labels, scheme or ("iid" if iid else "shard"),
+                          num_users, seed, 200, alpha)
+        dataloader_allusr = [ArrayLoader(ArrayDataset(dataset_train.images, dataset_train.labels, idxs, mean, std), batch_size, shuffle=True)
+                             for idxs in users]
+        test_loader = ArrayLoader(dataset_test, batch_size, shuffle=False)
+        train_loader = ArrayLoader(dataset_train, batch_size, shuffle=False)
+        return dataloader_allusr, train_loader, test_loader
+    elif backend != "torchvision":
+        raise ValueError("only support torchvision and memmap backend")
     trans_mnist = tv.transforms.Compose(
         [tv.transforms.ToTensor(), tv.transforms.Normalize((0.1307,), (0.3081,))])
     dataset_train = tv.datasets.MNIST(
         root=r'data', train=True, transform=trans_mnist, download=True)
     dataset_test = tv.datasets.MNIST(
         root=r'data', train=False, transform=trans_mnist, download=True)
-    # if iid:
-    if iid:
-        dict_users = mnist_iid(dataset_train, num_users)
-    else:
-        dict_users = mnist_noniid(dataset_train, num_users)
-
-    datasets_allusr = [DatasetSplit(dataset_train, dict_users[key])
-                       for key in dict_users.keys()]
+    users = partition("mnist", dataset_train.targets, scheme or ("iid" if iid else "shard"),
+                      num_users, seed, 200, alpha)
+    datasets_allusr = [DatasetSplit(dataset_train, idxs) for idxs in users]
     dataloader_allusr = [DataLoader(
         datasets_allusr[i], batch_size, shuffle=True) for i in range(num_users)]
     test_loader = DataLoader(dataset_test, batch_size, shuffle=False)
@@ -61,77 +262,7 @@ def load_mnist(iid: bool, num_users: int, batch_size: int):
     return dataloader_allusr, train_loader, test_loader
 
 
-def mnist_iid(dataset: data.Dataset, num_users: int) -> dict:
-    """
-    Split the MNIST dataset into IID data
-    -----
-    parameters:
-    --------
-    dataset: data.Dataset
-        the MNIST dataset
-    num_users: int
-        the number of users
-    --------
-    Returns:
-    --------
-    dict:
-        the index IID data of each user
-    """
-    num_items = int(len(dataset)/num_users)
-
-    dict_users, all_idxs = {}, [i for i in range(len(dataset))]
-
-    for i in range(num_users):
-        dict_users[i] = set(np.random.choice(
-            all_idxs, num_items, replace=False))
-        all_idxs = list(set(all_idxs)-dict_users[i])
-    return dict_users
-
-
-def mnist_noniid(dataset: data.Dataset, num_users: int) -> dict:
-    """
-    Split the MNIST dataset into non-IID data
-    -----
-    parameters:
-    --------
-    dataset: data.Dataset
-        the MNIST dataset
-    num_users: int
-        the number of users
-    --------
-    Returns:
-    --------
-    dict:
-        the index non-IID data of each user
-    """
-    # split the train MNIST dataset into 200 groups, each group contains 300 samples
-    num_shards, num_imgs = 200, 300  # 200*300 = 60000
-    idx_shard = [i for i in range(num_shards)]
-    dict_users = {i: np.array([], dtype=np.int64) for i in range(num_users)}
-
-    idxs = np.arange(num_shards*num_imgs)
-
-    labels = dataset.targets.numpy()
-
-    # sort labels to ensure non-iid
-    idx_labels = np.vstack((idxs, labels))
-    idx_labels = idx_labels[:, idx_labels[1, :].argsort()]
-    # sample index accroding to the arrangement of digital 1-9
-    idxs = idx_labels[0, :]
-
-    # divide and assign
-    for i in range(num_users):
-        rand_set = set(np.random.choice(
-            idx_shard, int(num_shards/num_users), replace=False))
-        idx_shard = list(set(idx_shard)-rand_set)
-        # concat
-        for rand in rand_set:
-            dict_users[i] = np.concatenate(
-                (dict_users[i], idxs[rand*num_imgs:(rand+1)*num_imgs]), axis=0)
-    return dict_users
-
-
-def load_cifar10(iid: bool, num_users: int, batch_size: int):
+def load_cifar10(iid: bool, num_users: int, batch_size: int, backend: str = "torchvision", augment: str = "pil", seed: int = None, scheme: str = None, alpha: float = 0.5):
     """
     Load the CIFAR-10 dataset
     -------
@@ -143,6 +274,16 @@ def load_cifar10(iid: bool, num_users: int, batch_size: int):
         the number of users
     batch_size: int
         the batch size
+    backend: str
+        torchvision or memmap, memmap serves batches from the decoded uint8 arrays
+    augment: str
+        pil or batched, batched crops and flips whole batches, memmap only supports batched
+    seed: int
+        the seed of the batched augmentation and the split, the split is cached in data/cache/partitions
+    scheme: str
+        iid, shard or dirichlet, None means iid if iid is True else shard
+    alpha: float
+        the concentration of the dirichlet split
     Returns:
     --------
     list[DataLoader]:
@@ -150,102 +291,66 @@ def load_cifar10(iid: bool, num_users: int, batch_size: int):
     Dataset
         the whole train and test dataset
     """
-    transform_train = transforms.Compose([
-        transforms.RandomCrop(32, padding=4),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-    ])
+    mean, std = (0.5, 0.5, 0.5), (0.5, 0.5, 0.5)
+    if augment not in ("pil", "batched"):
+        raise ValueError("only support pil and batched augmentation")
+    if backend == "memmap":
+        if augment != "batched":
+            raise ValueError(
+                "the memmap backend only supports batched augmentation")
+        # the uint8 images are padded with 0, the same as RandomCrop
+        batch_augment = BatchRandomCropFlip(padding=4, seed=seed, fill=0)
+        images, labels = cache_arrays("cifar10_train", lambda: tv.datasets.CIFAR10(
+            root=r'data', train=True, download=True))
+        dataset_train = ArrayDataset(
+            images, labels, np.arange(len(labels)), mean, std)
+        images, labels = cache_arrays("cifar10_test", lambda: tv.datasets.CIFAR10(
+            root=r'data', train=False, download=True))
+        dataset_test = ArrayDataset(
+            images, labels, np.arange(len(labels)), mean, std)
+        # 250 shards of 200 samples
+        users = partition("cifar10", dataset_train.labels, scheme or ("iid" if iid else "shard"),
+                          num_users, seed, 250, alpha)
+        dataloader_allusr = [ArrayLoader(ArrayDataset(dataset_train.images, dataset_train.labels, idxs, mean, std), batch_size, shuffle=True, augment=batch_augment)
+                             for idxs in users]
+        test_loader = ArrayLoader(dataset_test, batch_size, shuffle=False)
+        train_loader = ArrayLoader(
+            dataset_train, batch_size, shuffle=True, augment=batch_augment)
+        return dataloader_allusr, train_loader, test_loader
+    elif backend != "torchvision":
+        raise ValueError("only support torchvision and memmap backend")
 
     transform_test = transforms.Compose([
         transforms.ToTensor(),
-        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        transforms.Normalize(mean, std)
     ])
+    if augment == "pil":
+        transform_train = transforms.Compose([
+            transforms.RandomCrop(32, padding=4),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize(mean, std)
+        ])
+    else:
+        # the crops and flips are applied to the normalized batches
+        transform_train = transform_test
+        batch_augment = BatchRandomCropFlip(
+            padding=4, seed=seed, fill=[-m/s for m, s in zip(mean, std)])
     dataset_train = tv.datasets.CIFAR10(
         root=r'data', train=True, transform=transform_train, download=True)
     dataset_test = tv.datasets.CIFAR10(
         root=r'data', train=False, transform=transform_test, download=True)
-    # if iid:
-    if iid:
-        dict_users = cifar10_iid(dataset_train, num_users)
-    else:
-        dict_users = cifar10_noniid(dataset_train, num_users)
-
-    datasets_allusr = [DatasetSplit(dataset_train, dict_users[key])
-                       for key in dict_users.keys()]
+    # the targets of CIFAR10 are a list
+    users = partition("cifar10", dataset_train.targets, scheme or ("iid" if iid else "shard"),
+                      num_users, seed, 250, alpha)
+    datasets_allusr = [DatasetSplit(dataset_train, idxs) for idxs in users]
     dataloader_allusr = [DataLoader(
         datasets_allusr[i], batch_size, shuffle=True) for i in range(num_users)]
     test_loader = DataLoader(dataset_test, batch_size, shuffle=False)
     train_loader = DataLoader(dataset_train, batch_size, shuffle=True)
+    if augment == "batched":
+        dataloader_allusr = [AugmentedLoader(loader, batch_augment)
+                             for loader in dataloader_allusr]
+        train_loader = AugmentedLoader(train_loader, batch_augment)
 
     return dataloader_allusr, train_loader, test_loader
-
-
-def cifar10_iid(dataset: data.Dataset, num_users: int) -> dict:
-    """
-    Split the cifar10 dataset into IID data
-    -----
-    parameters:
-    --------
-    dataset: data.Dataset
-        the cifar10 dataset
-    num_users: int
-        the number of users
-    --------
-    Returns:
-    --------
-    dict:
-        the index IID data of each user
-    """
-    num_items = int(len(dataset)/num_users)
-
-    dict_users, all_idxs = {}, [i for i in range(len(dataset))]
-
-    for i in range(num_users):
-        dict_users[i] = set(np.random.choice(
-            all_idxs, num_items, replace=False))
-        all_idxs = list(set(all_idxs)-dict_users[i])
-    return dict_users
-
-
-def cifar10_noniid(dataset: data.Dataset, num_users: int) -> dict:
-    """
-    Split the cifar10 dataset into non-IID data
-    -----
-    parameters:
-    --------
-    dataset: data.Dataset
-        the cifar10 dataset
-    num_users: int
-        the number of users
-    --------
-    Returns:
-    --------
-    dict:
-        the index non-IID data of each user
-    """
-    # split the train cifar10 dataset into 250 groups, each group contains 200 samples
-    num_shards, num_imgs = 250, 200  # 250*200 = 50000
-    idx_shard = [i for i in range(num_shards)]
-    dict_users = {i: np.array([], dtype=np.int64) for i in range(num_users)}
-
-    idxs = np.arange(num_shards*num_imgs)
-
-    labels = dataset.targets.numpy()
-
-    # sort labels to ensure non-iid
-    idx_labels = np.vstack((idxs, labels))
-    idx_labels = idx_labels[:, idx_labels[1, :].argsort()]
-    # sample index accroding to the arrangement of digital 1-9
-    idxs = idx_labels[0, :]
-
-    # divide and assign
-    for i in range(num_users):
-        rand_set = set(np.random.choice(
-            idx_shard, int(num_shards/num_users), replace=False))
-        idx_shard = list(set(idx_shard)-rand_set)
-        # concat
-        for rand in rand_set:
-            dict_users[i] = np.concatenate(
-                (dict_users[i], idxs[rand*num_imgs:(rand+1)*num_imgs]), axis=0)
-    return dict_users
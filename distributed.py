@@ -0,0 +1,363 @@
+import os
+import time
+import random
+import argparse
+import yaml
+import numpy as np
+import torch as t
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from copy import deepcopy
+from tensorboardX import SummaryWriter
+import utils
+from utils import get_weight_num, get_component_keys, create_folder
+from channel import (calculate_E_batch,
+                     compute_power_coeff_batch,
+                     compute_alpha_neighbors,
+                     calculate_agg_var_graph)
+from topology import TopologySchedule
+from runner import ModelRunner
+from DLLSOA import LocalClient, load_data, build_model, get_sub_carrier_nums
+
+
+class DistributedRuntime(object):
+    """
+    The decentralized runtime in which every rank owns the clients i with i % world_size == rank.
+    The ranks only exchange what the devices would: the masks and the norms of the components,
+    the power allocation coefficients chosen by the receivers, and the power-scaled components.
+    The components sent by the clients of a rank to the same receiver are superposed before they
+    leave the rank, the receiver adds the partial sums of all ranks and the channel noise.
+    All receivers mix the parameters at the end of the local update phase.
+    """
+
+    def __init__(self, args: dict, rank: int, world_size: int):
+        """
+        Parameters:
+        -------
+        args: the configuration, the same on every rank
+        rank: the rank of this process
+        world_size: the number of processes
+        """
+        self.rank = rank
+        self.world_size = world_size
+        self.num_clients = args["num_clients"]
+        self.seed = args["seed"]
+        self.sigma = args["sigma"]
+        self.beta = args["beta"]
+        self.beta_noise = args["beta_noise"]
+        self.pow_limit = args["pow_limit"]
+        self.amendment_strategy = args["amendment_strategy"]
+        if self.amendment_strategy not in ("eq5", "eq6"):
+            raise ValueError("Unsupported value, only support eq5 and eq6")
+        self.aggregation_mode = args["aggregation_mode"]
+        self.disable_com = args["disable_com"]
+        self.train_epoch = args["train_epoch"]
+        # the options of the simulator which the runtime does not implement
+        if args["comp_strategy"] not in ("random", "weight", "grad"):
+            raise ValueError(
+                "the distributed runtime only supports random, weight and grad")
+        if args.get("codec", "none") != "none" or args.get("codec_delta", False):
+            raise ValueError(
+                "the distributed runtime only supports the none codec without codec_delta")
+        if args.get("engine", "module") != "module" or args.get("train_mode", "sequential") != "sequential":
+            raise ValueError(
+                "the distributed runtime only supports the module engine and sequential train_mode")
+        if args.get("execution", "sync") != "sync":
+            raise ValueError(
+                "the distributed runtime only supports sync execution")
+        # legacy draws the graphs from the global random state of the simulator, the ranks
+        # resample a graph from the seed every round instead, without topo_every and topo_file
+        topo_schedule = args.get("topo_schedule", "legacy")
+        if topo_schedule == "legacy" and (args.get("topo_every", 1) != 1 or args.get("topo_file", None) is not None):
+            raise ValueError(
+                "the legacy topo_schedule only supports topo_every 1 without topo_file, use static, resample or replay")
+        # every rank splits the dataset and draws the subcarriers and the channels identically
+        random.seed(self.seed)
+        dataloader_allusr, _, test_loader, _ = load_data(args)
+        t.manual_seed(self.seed)
+        net = build_model(args)
+        transmit_buffers = args.get("transmit_buffers", False)
+        sub_carrier_nums = get_sub_carrier_nums(
+            args, get_weight_num(net, transmit_buffers))
+        channel_rng = np.random.default_rng(self.seed)
+        channel_gains = [channel_rng.rayleigh(1., size=(self.num_clients, num))
+                         for num in sub_carrier_nums]
+        self.owned = list(range(rank, self.num_clients, world_size))
+        self.clients = {}
+        for i in self.owned:
+            # the initialization of a client does not depend on the number of ranks
+            t.manual_seed(self.seed*1000003+i)
+            self.clients[i] = LocalClient(i, deepcopy(net), dataloader_allusr[i], test_loader,
+                                          nn.CrossEntropyLoss(), args["comp_strategy"], args["lr"],
+                                          args["ep_num"], sub_carrier_nums[i], t.device("cpu"),
+                                          channel_gains[i], self.pow_limit, args["pow_allocation_strategy"],
+                                          transmit_buffers=transmit_buffers, fold_bn=args.get("fold_bn", False))
+        # the cpu execution options, see DLLSOA
+        runner = ModelRunner(net, args.get("channels_last", False),
+                             args.get("autocast", "none"), args.get("compile", False))
+        if runner.enabled:
+            for client in self.clients.values():
+                runner.prepare(client.model)
+                client.runner = runner
+        # the numel of every component
+        state_dict = net.state_dict()
+        self.numels = {name: state_dict[name].numel()
+                       for name in get_component_keys(net, transmit_buffers)}
+        self.positions = {name: idx for idx,
+                          name in enumerate(self.numels.keys())}
+        # the graph of every round is generated from the seed, so that all ranks agree on it
+        self.schedule = TopologySchedule(args.get("topology", "dense"), self.num_clients,
+                                         "resample" if topo_schedule == "legacy" else topo_schedule,
+                                         args.get("topo_every", 1), self.seed,
+                                         args.get("topo_degree", 4), args.get("topo_radius", 0.1),
+                                         args.get("topo_file", None), self.train_epoch)
+        self.beta_rngs = {i: np.random.default_rng([self.seed, i])
+                          for i in self.owned}
+        # rank 0 writes the logs
+        self.writer = None
+        if rank == 0:
+            log_dir = os.path.join(args["log_dir"], args["dataset"], time.strftime(
+                "%Y-%m-%d-%H-%M-%S", time.localtime()))
+            create_folder(log_dir)
+            self.writer = SummaryWriter(log_dir)
+            with open(os.path.join(log_dir, "config.yaml"), "w") as f:
+                yaml.dump(args, f)
+
+    def manual_seed(self, round: int, stream: int):
+        """
+        seed torch and random for a client in a round, so that the shuffling of the local update,
+        the random masks and the channel noise of a client do not depend on which rank owns it
+        """
+        seed = int(np.random.SeedSequence(
+            [self.seed, round, stream]).generate_state(1)[0])
+        t.manual_seed(seed)
+        random.seed(seed)
+
+    def owner(self, i: int) -> int:
+        """
+        the rank of client i
+        """
+        return i % self.world_size
+
+    def communicate(self, round: int):
+        """
+        the communication phase of a round
+        ------
+        Parameters:
+            round: the index of the round
+        Returns:
+            the communication data size and data amount of the whole network
+        """
+        graph = self.schedule.graph(round)
+        sigmas = calculate_agg_var_graph(
+            graph, self.sigma, self.aggregation_mode)
+        # 1. the masks and the norms of all clients
+        local = {}
+        for i, client in self.clients.items():
+            self.manual_seed(round, 2*self.num_clients+i)
+            local[i] = (client.generate_mask(),
+                        [(key, float(norm)) for key, norm in client.weight_norm(None)])
+        gathered = [None for _ in range(self.world_size)]
+        dist.all_gather_object(gathered, local)
+        masks, norms = {}, {}
+        for part in gathered:
+            for i, (mask, norm) in part.items():
+                masks[i] = mask
+                norms[i] = dict(norm)
+        # 2. the receivers compute the power allocation coefficients of their neighbors
+        local = {}
+        for i, client in self.clients.items():
+            neighbors, weights = graph.neighbors(i)
+            if len(neighbors) == 0:
+                continue
+            # the norms of the masked components in the order of the parameters
+            keys = sorted(masks[i], key=self.positions.__getitem__)
+            weight_norm = np.array([[norms[j][key] for key in keys]
+                                    for j in neighbors])
+            h = client.channel_gain[i]
+            beta = self.beta_rngs[i].normal(
+                0.0, self.beta_noise, size=len(neighbors))+self.beta
+            E = calculate_E_batch(weights, weight_norm, h, beta)
+            b, xi = compute_power_coeff_batch(
+                E, weights, h, weight_norm, self.pow_limit, client.pow_allow_stg)
+            # the scale of every component of the mask, see LocalClient.transmit
+            scale = b[:, :len(masks[i])]*h[:len(masks[i])]
+            local[i] = (neighbors, scale, xi, weights)
+        gathered = [None for _ in range(self.world_size)]
+        dist.all_gather_object(gathered, local)
+        coeffs = {}
+        for part in gathered:
+            coeffs.update(part)
+        # 3. the clients of this rank superpose their scaled components for every receiver
+        payloads = {}
+        data_amount = 0
+        for i, (neighbors, scale, _, _) in coeffs.items():
+            keys = sorted(masks[i], key=self.positions.__getitem__)
+            column = {key: idx for idx, key in enumerate(masks[i])}
+            numel = sum(self.numels[key] for key in keys)
+            data_amount += numel*len(neighbors)
+            senders = [(k, j)
+                       for k, j in enumerate(neighbors) if j in self.clients]
+            if len(senders) == 0:
+                continue
+            payload = t.zeros(numel)
+            with t.no_grad():
+                for k, j in senders:
+                    offset = 0
+                    for key in keys:
+                        size = self.numels[key]
+                        payload[offset:offset+size].add_(self.clients[j].components[key].reshape(-1),
+                                                         alpha=float(scale[k, column[key]]))
+                        offset += size
+            payloads[i] = payload
+        # 4. send the partial sums to the ranks of the receivers
+        requests = []
+        received = {i: [] for i in self.clients}
+        for i, payload in payloads.items():
+            if self.owner(i) != self.rank:
+                requests.append(dist.isend(payload, self.owner(i), tag=i))
+        for i in self.clients:
+            if i not in coeffs:
+                continue
+            numel = payloads[i].numel() if i in payloads else sum(
+                self.numels[key] for key in masks[i])
+            for src in sorted({self.owner(j) for j in coeffs[i][0]} - {self.rank}):
+                buffer = t.empty(numel)
+                requests.append(dist.irecv(buffer, src, tag=i))
+                received[i].append(buffer)
+        for request in requests:
+            request.wait()
+        # 5. add the noise of the channel and update the parameters
+        for i, client in self.clients.items():
+            if i not in coeffs:
+                continue
+            neighbors, _, xi, weights = coeffs[i]
+            signal = payloads[i] if i in payloads else received[i].pop()
+            for partial in received[i]:
+                signal.add_(partial)
+            self.manual_seed(round, self.num_clients+i)
+            signal.add_(t.randn_like(signal), alpha=float(sigmas[i]))
+            alpha = compute_alpha_neighbors(
+                xi, weights if self.amendment_strategy == "eq6" else None, self.pow_limit)
+            processed_model = {}
+            offset = 0
+            for key in sorted(masks[i], key=self.positions.__getitem__):
+                size = self.numels[key]
+                processed_model[key] = signal[offset:offset +
+                                              size].view_as(client.components[key])
+                offset += size
+            client.rcv_params(processed_model, None, None, self.amendment_strategy,
+                              alpha, graph.self_weights[i])
+        data_size = data_amount*4
+        return data_size, data_amount
+
+    def train(self):
+        """
+        begin the training procedure
+        """
+        if self.rank == 0:
+            print("distributed training begin...")
+        for ep in range(self.train_epoch):
+            losses = {}
+            for i, client in self.clients.items():
+                self.manual_seed(ep, i)
+                losses[i] = client.train()
+            data_size, data_amount = 0, 0
+            if not self.disable_com:
+                data_size, data_amount = self.communicate(ep)
+            test_loss_acc = {i: client.test()
+                             for i, client in self.clients.items()}
+            gathered = [None for _ in range(self.world_size)]
+            dist.all_gather_object(
+                gathered, (losses, {i: (float(loss), float(acc)) for i, (loss, acc) in test_loss_acc.items()}))
+            if self.rank == 0:
+                losses, test_loss_acc = {}, {}
+                for part_losses, part_test in gathered:
+                    losses.update(part_losses)
+                    test_loss_acc.update(part_test)
+                self.log(ep, [losses[i] for i in range(self.num_clients)],
+                         [test_loss_acc[i] for i in range(self.num_clients)], data_size, data_amount)
+        self.schedule.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    def log(self, ep: int, losses: list, test_loss_acc: list, data_size: int, data_amount: int):
+        """
+        Tensorboard logs and print loss, the same scalars as DLLSOA.log
+        """
+        for i in range(self.num_clients):
+            self.writer.add_scalar(
+                "test_loss_client_{}".format(i), test_loss_acc[i][0], ep)
+            self.writer.add_scalar(
+                "test_acc_client_{}".format(i), test_loss_acc[i][1], ep)
+            self.writer.add_scalar(
+                "train_loss_client_{}".format(i), losses[i], ep)
+        self.writer.add_scalar("mean_train_loss", np.mean(losses), ep)
+        self.writer.add_scalar("mean_test_loss", np.mean(
+            [loss for loss, _ in test_loss_acc]), ep)
+        self.writer.add_scalar("mean_test_acc", np.mean(
+            [acc for _, acc in test_loss_acc]), ep)
+        self.writer.add_scalar("data_size (MB)", data_size/1024/1024, ep)
+        self.writer.add_scalar("data_amount (M)", data_amount/1000000, ep)
+        print(
+            f"ep:[{ep}/{self.train_epoch}],train_loss:{losses},test_loss_acc:{test_loss_acc}")
+
+
+def run(rank: int, world_size: int, args: dict, init_method: str, num_threads: int):
+    """
+    the entry of a rank
+    ------
+    Parameters:
+        rank: the rank of this process
+        world_size: the number of processes
+        args: the configuration
+        init_method: the url of the rendezvous, e.g. tcp://127.0.0.1:29500 or env://
+        num_threads: the intra-op thread number of the rank
+    """
+    t.set_num_threads(num_threads)
+    dist.init_process_group("gloo", init_method=init_method,
+                            rank=rank, world_size=world_size)
+    try:
+        DistributedRuntime(args, rank, world_size).train()
+    finally:
+        dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="distributed_DLLSOA", description="run DLLSOA with one process per group of clients"
+    )
+    parser.add_argument(
+        "config_path",
+        type=str,
+        help="the config file path",
+    )
+    parser.add_argument(
+        "--nprocs",
+        type=int,
+        help="the number of processes started on this machine, ignored if launched by torchrun",
+        default=2,
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="the port of the rendezvous on localhost",
+        default=29500,
+    )
+    config_arg = parser.parse_args()
+    args = utils.load_config(config_arg.config_path)
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        # launched by torchrun, possibly on many nodes
+        world_size = int(os.environ["WORLD_SIZE"])
+        num_threads = max(1, os.cpu_count() //
+                          int(os.environ.get("LOCAL_WORLD_SIZE", world_size)))
+        run(int(os.environ["RANK"]), world_size, args, "env://", num_threads)
+    else:
+        world_size = config_arg.nprocs
+        mp.spawn(run, args=(world_size, args, f"tcp://127.0.0.1:{config_arg.port}",
+                            max(1, os.cpu_count()//world_size)), nprocs=world_size)
+
+
+if __name__ == "__main__":
+    main()
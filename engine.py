@@ -0,0 +1,328 @@
+import torch as t
+import torch.nn as nn
+import numpy as np
+from torch import Tensor
+from collections import defaultdict
+from utils import functional_call
+
+
+class FlatParamEngine(object):
+    """
+    Keep the parameters of all clients in one contiguous [num_clients, num_params] tensor.
+    The parameters of every client model become views into its own row, so the
+    population can be processed with batched tensor operations.
+    """
+
+    def __init__(self, models: list[nn.Module], device: t.device):
+        """
+        Parameters:
+        -------
+        models: the client models, they must share the same architecture
+        device: the device of the flat buffers
+        """
+        template = models[0]
+        self.names = [name for name, _ in template.named_parameters()]
+        self.shapes = [param.shape for _, param in template.named_parameters()]
+        self.numels = [param.numel()
+                       for _, param in template.named_parameters()]
+        self.offsets = [0]
+        for numel in self.numels[:-1]:
+            self.offsets.append(self.offsets[-1]+numel)
+        # the index of every component (parameter tensor)
+        self.index = {name: k for k, name in enumerate(self.names)}
+        self.num_clients = len(models)
+        self.num_params = sum(self.numels)
+        self.device = device
+        # the flat buffers of the parameters and the gradients
+        self.params = t.empty(self.num_clients, self.num_params, device=device)
+        self.grads = t.zeros(self.num_clients, self.num_params, device=device)
+        self.client_params = []
+        with t.no_grad():
+            for i, model in enumerate(models):
+                model_params = [param for _, param in model.named_parameters()]
+                if len(model_params) != len(self.names):
+                    raise ValueError(
+                        "all clients should share the same architecture")
+                for param, offset, numel in zip(model_params, self.offsets, self.numels):
+                    self.params[i, offset:offset+numel].copy_(param.view(-1))
+                    # the parameter becomes a view of the flat buffer
+                    param.data = self.params[i, offset:offset+numel].view_as(param)
+                    param.grad = self.grads[i, offset:offset +
+                                            numel].view_as(param)
+                self.client_params.append(model_params)
+
+    def segment(self, k: int) -> Tensor:
+        """
+        get the k-th component of all clients
+        ------
+        Parameters:
+            k: the index of the component
+        Returns:
+            a [num_clients, numel] view of the flat buffer
+        """
+        return self.params[:, self.offsets[k]:self.offsets[k]+self.numels[k]]
+
+    def segment_norms(self) -> Tensor:
+        """
+        compute the 2nd-norm of every component of every client
+        ------
+        Returns:
+            a [num_clients, num_components] tensor
+        """
+        with t.no_grad():
+            return t.stack([self.segment(k).norm(dim=1) for k in range(len(self.names))], dim=1)
+
+    def component_mask(self, component_keys: list[str]) -> Tensor:
+        """
+        convert the component keys into a boolean mask over the components
+        """
+        mask = t.zeros(len(self.names), dtype=t.bool)
+        mask[[self.index[key] for key in component_keys]] = True
+        return mask
+
+    def over_the_air(self, coeff: Tensor, masks: Tensor, self_weight: Tensor, alpha: Tensor, sigma: Tensor):
+        """
+        over-the-air aggregation of the whole population, the receivers mix the
+        snapshot of the parameters at the beginning of the communication phase
+        ------
+        Parameters:
+            coeff: [num_clients, num_clients, num_components], the coefficient b_ij(k)*h_ij(k)
+                of the component k that client j sends to client i, 0 if not sent
+            masks: [num_clients, num_components], whether the receiver updates the component
+            self_weight: [num_clients], the W_ii of each receiver
+            alpha: [num_clients], the estimated alpha of each receiver
+            sigma: [num_clients], the std of the Gaussian noise of each receiver
+        Returns:
+            None
+        """
+        coeff = coeff.to(self.device)
+        masks = masks.to(self.device)
+        self_weight = self_weight.to(self.device).unsqueeze(1)
+        alpha = alpha.to(self.device).unsqueeze(1)
+        sigma = sigma.to(self.device).unsqueeze(1)
+        with t.no_grad():
+            for k in range(len(self.names)):
+                keep = masks[:, k]
+                if not keep.any():
+                    continue
+                seg = self.segment(k)
+                # superposition of the signals of all neighbors
+                agg = coeff[:, :, k] @ seg
+                # add noise to the received signal
+                agg += t.randn_like(agg)*sigma
+                agg = agg*alpha+seg*self_weight
+                seg.copy_(t.where(keep.unsqueeze(1), agg, seg))
+
+    def share_memory_(self):
+        """
+        move the flat buffers to the shared memory
+        """
+        self.params.share_memory_()
+        self.grads.share_memory_()
+        return self
+
+
+class FlatAdam(object):
+    """
+    Adam whose moments of all clients are stored in [num_clients, num_params] tensors,
+    the update of a client is a handful of fused operations over its row.
+    """
+
+    def __init__(self, engine: FlatParamEngine, lr: float, betas=(0.9, 0.999), eps=1e-8):
+        self.engine = engine
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.exp_avg = t.zeros_like(engine.params)
+        self.exp_avg_sq = t.zeros_like(engine.params)
+        self.steps = t.zeros(engine.num_clients,
+                             dtype=t.float64, device=engine.device)
+
+    def zero_grad(self, rows: slice):
+        """
+        zero the gradients of the given clients
+        """
+        self.engine.grads[rows].zero_()
+        # make sure autograd keeps accumulating into the flat buffer
+        for i in range(*rows.indices(self.engine.num_clients)):
+            for param, offset, numel in zip(self.engine.client_params[i], self.engine.offsets, self.engine.numels):
+                if param.grad is None or param.grad.data_ptr() != self.engine.grads[i, offset].data_ptr():
+                    param.grad = self.engine.grads[i, offset:offset +
+                                                   numel].view_as(param)
+
+    def step(self, rows):
+        """
+        perform a single Adam step for the given clients
+        ------
+        Parameters:
+            rows: a slice or a LongTensor of the client ids
+        """
+        with t.no_grad():
+            if isinstance(rows, slice):
+                # update the rows in place
+                self._update(self.engine.params[rows], self.engine.grads[rows],
+                             self.exp_avg[rows], self.exp_avg_sq[rows], rows)
+            else:
+                param = self.engine.params[rows]
+                exp_avg = self.exp_avg[rows]
+                exp_avg_sq = self.exp_avg_sq[rows]
+                self._update(param, self.engine.grads[rows],
+                             exp_avg, exp_avg_sq, rows)
+                self.engine.params[rows] = param
+                self.exp_avg[rows] = exp_avg
+                self.exp_avg_sq[rows] = exp_avg_sq
+
+    def _update(self, param: Tensor, grad: Tensor, exp_avg: Tensor, exp_avg_sq: Tensor, rows):
+        beta1, beta2 = self.betas
+        self.steps[rows] += 1
+        steps = self.steps[rows]
+        bias_correction1 = (1-beta1**steps).to(param.dtype).unsqueeze(1)
+        bias_correction2 = (1-beta2**steps).to(param.dtype).unsqueeze(1)
+        exp_avg.lerp_(grad, 1-beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
+        denom = (exp_avg_sq.sqrt()/bias_correction2.sqrt()).add_(self.eps)
+        param.addcdiv_(exp_avg/bias_correction1, denom, value=-self.lr)
+
+    def view(self, id: int):
+        """
+        get the optimizer of a single client
+        """
+        return FlatAdamView(self, id)
+
+    def share_memory_(self):
+        """
+        move the moments to the shared memory
+        """
+        self.exp_avg.share_memory_()
+        self.exp_avg_sq.share_memory_()
+        self.steps.share_memory_()
+        return self
+
+
+class FlatAdamView(object):
+    """
+    The optimizer of a single client, it has the same interface as t.optim.Optimizer
+    """
+
+    def __init__(self, optimizer: FlatAdam, id: int):
+        self.optimizer = optimizer
+        self.rows = slice(id, id+1)
+
+    def zero_grad(self, set_to_none: bool = False):
+        self.optimizer.zero_grad(self.rows)
+
+    def step(self):
+        self.optimizer.step(self.rows)
+
+
+class VmapTrainer(object):
+    """
+    Train the clients of the flat engine with vmap, the forward and backward passes
+    of a chunk of clients are computed in one batched call, while every client
+    still uses the batches of its own train_loader.
+    """
+
+    def __init__(self, engine: FlatParamEngine, optimizer: FlatAdam, models: list[nn.Module], loss_func: nn.Module, chunk_size: int = None):
+        """
+        Parameters:
+        -------
+        engine: the flat engine which holds the parameters of the clients
+        optimizer: the flat Adam of the engine
+        models: the models of the clients, the first one is used as the template
+        loss_func: the loss function
+        chunk_size: the number of clients trained together, None means all clients
+        """
+        self.engine = engine
+        self.optimizer = optimizer
+        self.template = models[0]
+        self.loss_func = loss_func
+        self.chunk_size = chunk_size if chunk_size else engine.num_clients
+        self.buffers = [dict(model.named_buffers()) for model in models]
+        # vmap is only required by this trainer
+        try:
+            from torch.func import vmap
+        except ImportError:
+            # torch<2.0 ships vmap in the functorch package
+            from functorch import vmap
+        self.batched_loss = vmap(
+            self._loss, in_dims=(0, 0, 0, 0), randomness="different")
+
+    def _loss(self, params: dict, buffers: dict, X: Tensor, y: Tensor):
+        y_hat = functional_call(self.template, params, buffers, (X,))
+        return self.loss_func(y_hat, y)
+
+    def _rows(self, ids: list[int]):
+        # use a slice if the clients are contiguous so that the update is in place
+        if ids == list(range(ids[0], ids[-1]+1)):
+            return slice(ids[0], ids[-1]+1)
+        return t.tensor(ids, device=self.engine.device)
+
+    def step(self, ids: list[int], X: Tensor, y: Tensor):
+        """
+        perform a training step for the given clients
+        ------
+        Parameters:
+            ids: the ids of the clients
+            X: [len(ids), batch_size, ...], the stacked inputs
+            y: [len(ids), batch_size], the stacked labels
+        Returns:
+            the loss of each client
+        """
+        rows = self._rows(ids)
+        flat = self.engine.params[rows]
+        # every component is a leaf so that autograd does not expand the gradients to the whole row
+        params = {name: flat[:, offset:offset+numel].view(len(ids), *shape).detach().requires_grad_()
+                  for name, shape, offset, numel in zip(self.engine.names, self.engine.shapes, self.engine.offsets, self.engine.numels)}
+        buffers = {name: t.stack([self.buffers[i][name] for i in ids])
+                   for name in self.buffers[0].keys()}
+        losses = self.batched_loss(params, buffers, X, y)
+        grads = t.autograd.grad(losses.sum(), list(params.values()))
+        with t.no_grad():
+            for grad, offset, numel in zip(grads, self.engine.offsets, self.engine.numels):
+                self.engine.grads[rows, offset:offset +
+                                  numel] = grad.reshape(len(ids), numel)
+            # write back the running statistics
+            for name, buffer in buffers.items():
+                for k, i in enumerate(ids):
+                    self.buffers[i][name].copy_(buffer[k])
+        self.optimizer.step(rows)
+        return losses.detach().cpu().numpy()
+
+    def train(self, loaders: list, ep_num: int):
+        """
+        train all clients for a round
+        ------
+        Parameters:
+            loaders: the train_loader of each client
+            ep_num: the number of local epochs
+        Returns:
+            the loss of the trainset of each client
+        """
+        losses = [None]*self.engine.num_clients
+        for start in range(0, self.engine.num_clients, self.chunk_size):
+            chunk = list(range(start, min(start+self.chunk_size,
+                                          self.engine.num_clients)))
+            for ep in range(ep_num):
+                ep_loss = {i: [] for i in chunk}
+                iters = {i: iter(loaders[i]) for i in chunk}
+                while len(iters) != 0:
+                    batches = {}
+                    for i in list(iters.keys()):
+                        try:
+                            batches[i] = next(iters[i])
+                        except StopIteration:
+                            del iters[i]
+                    # the clients with the same batch shape are stacked together
+                    groups = defaultdict(list)
+                    for i, (X, _) in batches.items():
+                        groups[tuple(X.shape)].append(i)
+                    for ids in groups.values():
+                        X = t.stack([batches[i][0]
+                                    for i in ids]).to(self.engine.device)
+                        y = t.stack([batches[i][1]
+                                    for i in ids]).to(self.engine.device)
+                        for i, loss in zip(ids, self.step(ids, X, y)):
+                            ep_loss[i].append(loss)
+            for i in chunk:
+                losses[i] = np.mean(ep_loss[i])
+        return losses
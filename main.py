@@ -14,10 +14,18 @@ def main():
         default="configs/dllsoa_template.yaml",
 
     )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        help="resume the training from the checkpoint file",
+        default=None,
+    )
 
     config_arg = parser.parse_args()
     args = utils.load_config(config_arg.config_path)
     model = DLLSOA(args)
+    if config_arg.resume is not None:
+        model.load_checkpoint(config_arg.resume)
     model.train()
 
 
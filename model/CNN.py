@@ -4,19 +4,67 @@ import torch.nn as nn
 
 
 class CNN(nn.Module):
-    def __init__(self):
+    """
+    The plain CNN with two 5x5 convolution layers and three dense layers.
+    """
+
+    def __init__(self, num_channels: int = 1, num_classes: int = 10, image_size: int = 28) -> None:
+        """
+        Parameters:
+        -------
+        num_channels: number of channels of the input images
+        num_classes: number of the classes
+        image_size: the height (and width) of the input images, 28 for MNIST and 32 for CIFAR10
+        """
         super().__init__()
+        # the two convolution layers without padding shrink the images by 8 pixels
+        feature_size = image_size-8
         self.net = nn.Sequential(
-            nn.Conv2d(1, 16, kernel_size=5),
+            nn.Conv2d(num_channels, 16, kernel_size=5),
             nn.ReLU(),
             nn.Conv2d(16, 32, kernel_size=5),
             nn.ReLU(),
             nn.Flatten(),
-            nn.Linear(20*20*32, 784),
+            nn.Linear(feature_size*feature_size*32, 784),
             nn.ReLU(),
             nn.Linear(784, 256),
             nn.ReLU(),
-            nn.Linear(256, 10)
+            nn.Linear(256, num_classes)
+        )
+
+    def forward(self, x: t.Tensor):
+        return self.net.forward(x)
+
+
+class SlimCNN(nn.Module):
+    """
+    The slim CNN, every convolution layer is followed by a 2x2 max pooling so that the
+    dense layers are small. It has about 0.2M parameters on MNIST instead of the 10M of CNN.
+    """
+
+    def __init__(self, num_channels: int = 1, num_classes: int = 10, image_size: int = 28, width: int = 16) -> None:
+        """
+        Parameters:
+        -------
+        num_channels: number of channels of the input images
+        num_classes: number of the classes
+        image_size: the height (and width) of the input images, 28 for MNIST and 32 for CIFAR10
+        width: number of channels of the first convolution layer, the second one has 2*width
+        """
+        super().__init__()
+        # the two poolings shrink the images by 4 times
+        feature_size = image_size//4
+        self.net = nn.Sequential(
+            nn.Conv2d(num_channels, width, kernel_size=5, padding=2),
+            nn.ReLU(),
+            nn.MaxPool2d(2),
+            nn.Conv2d(width, 2*width, kernel_size=5, padding=2),
+            nn.ReLU(),
+            nn.MaxPool2d(2),
+            nn.Flatten(),
+            nn.Linear(feature_size*feature_size*2*width, 128),
+            nn.ReLU(),
+            nn.Linear(128, num_classes)
         )
 
     def forward(self, x: t.Tensor):
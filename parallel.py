@@ -0,0 +1,158 @@
+import os
+import torch as t
+import torch.multiprocessing as mp
+from dataset import augment_generators
+
+
+def _worker(conn, clients: list, num_threads: int, seed: int, shared_grads: list, rng_state: t.Tensor = None):
+    """
+    the loop of a worker process, it trains its own clients whenever the parent asks
+    ------
+    Parameters:
+        conn: the pipe to the parent process
+        clients: the clients owned by the worker
+        num_threads: the intra-op thread number of the worker
+        seed: the seed of the torch random number generator of the worker
+        shared_grads: the shared gradients of each client, None if the gradients are already shared
+        rng_state: the states of the torch random number generator and the batched augmentation
+            restored from a checkpoint
+    """
+    t.set_num_threads(num_threads)
+    t.manual_seed(seed)
+    # the forked workers inherit the generator of the batched augmentation, it is reseeded
+    # so that every worker draws its own crops and flips
+    generators = augment_generators([client.train_loader for client in clients])
+    for k, generator in enumerate(generators):
+        generator.manual_seed(seed*1000003+k)
+    if rng_state is not None:
+        # the older checkpoints only keep the torch random state
+        if isinstance(rng_state, t.Tensor):
+            rng_state = {"torch": rng_state, "augment": []}
+        t.set_rng_state(rng_state["torch"])
+        for generator, generator_state in zip(generators, rng_state["augment"]):
+            generator.set_state(generator_state)
+    while True:
+        cmd = conn.recv()
+        if cmd == "train":
+            losses = {}
+            for client, grads in zip(clients, shared_grads):
+                losses[client.id] = client.train()
+                # publish the gradients for the grad component strategy
+                if grads is not None:
+                    with t.no_grad():
+                        for grad, param in zip(grads, client.model.parameters()):
+                            if param.grad is not None:
+                                grad.copy_(param.grad)
+            conn.send(losses)
+        elif cmd == "state":
+            # the optimizers of the module engine are not shared with the parent
+            optimizers = {client.id: client.optimizer.state_dict() for client in clients
+                          if isinstance(client.optimizer, t.optim.Optimizer)}
+            conn.send(({"torch": t.get_rng_state(),
+                        "augment": [generator.get_state() for generator in generators]}, optimizers))
+        elif cmd == "close":
+            conn.close()
+            break
+
+
+class ClientPool(object):
+    """
+    A pool of worker processes which train the clients in parallel. The models live in
+    the shared memory, so the parent process can run the communication phase directly
+    on them without pickling any state dict.
+    """
+
+    def __init__(self, clients: list, num_workers: int, num_threads: int = None, engine=None, optimizer=None, seed: int = 0, rng_states: list = None):
+        """
+        Parameters:
+        -------
+        clients: all local clients, client i is trained by worker i % num_workers
+        num_workers: the number of worker processes
+        num_threads: the intra-op thread number of every worker, default is cpu_count // num_workers
+        engine: the flat engine, if not None, its buffers are moved to the shared memory
+        optimizer: the flat Adam of the engine
+        seed: the base seed of the workers
+        rng_states: the random states of the workers restored from a checkpoint
+        """
+        self.num_clients = len(clients)
+        if num_threads is None:
+            num_threads = max(1, os.cpu_count()//num_workers)
+        # move the models to the shared memory
+        if engine is not None:
+            engine.share_memory_()
+            optimizer.share_memory_()
+            for client in clients:
+                client.model.share_memory()
+            shared_grads = [None for _ in clients]
+        else:
+            shared_grads = []
+            for client in clients:
+                client.model.share_memory()
+                grads = []
+                for param in client.model.parameters():
+                    if param.grad is None:
+                        param.grad = t.zeros_like(param)
+                    grads.append(param.grad.share_memory_())
+                shared_grads.append(grads)
+        # fork the workers, the clients are inherited instead of pickled
+        ctx = mp.get_context("fork")
+        self.conns = []
+        self.workers = []
+        for rank in range(num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            worker = ctx.Process(target=_worker,
+                                 args=(child_conn,
+                                       clients[rank::num_workers],
+                                       num_threads,
+                                       seed+rank,
+                                       shared_grads[rank::num_workers],
+                                       rng_states[rank] if rng_states is not None else None),
+                                 daemon=True)
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+    def train(self):
+        """
+        train all clients for a round in parallel
+        ------
+        Returns:
+            the train loss of each client
+        """
+        for conn in self.conns:
+            conn.send("train")
+        losses = {}
+        for conn in self.conns:
+            losses.update(conn.recv())
+        return [losses[i] for i in range(self.num_clients)]
+
+    def get_state(self):
+        """
+        get the states of the workers for a checkpoint
+        ------
+        Returns:
+            the torch and augmentation random states of the workers and the optimizer states of their clients,
+            the latter is None if the optimizers are shared with the parent
+        """
+        for conn in self.conns:
+            conn.send("state")
+        rng_states = []
+        optimizers = {}
+        for conn in self.conns:
+            rng_state, client_optimizers = conn.recv()
+            rng_states.append(rng_state)
+            optimizers.update(client_optimizers)
+        return rng_states, optimizers if len(optimizers) != 0 else None
+
+    def close(self):
+        """
+        stop all workers
+        """
+        for conn in self.conns:
+            conn.send("close")
+            conn.close()
+        for worker in self.workers:
+            worker.join()
+        self.conns = []
+        self.workers = []
@@ -0,0 +1,140 @@
+import os
+import numpy as np
+from numpy import ndarray
+
+
+def iid_split(num_samples: int, num_users: int, rng: np.random.Generator) -> list[ndarray]:
+    """
+    split the samples into IID subsets of the same size with a single permutation
+    ------
+    Parameters:
+        num_samples: the number of samples
+        num_users: the number of users
+        rng: the random generator
+    Returns:
+        the sample indices of each user, the remainder of num_samples / num_users is dropped
+    """
+    num_items = num_samples//num_users
+    return list(rng.permutation(num_samples)[:num_items*num_users].reshape(num_users, num_items))
+
+
+def shard_split(labels: ndarray, num_users: int, num_shards: int, rng: np.random.Generator) -> list[ndarray]:
+    """
+    sort the samples by label, cut them into shards and give every user the same number of
+    random shards, so that every user only has a few labels
+    ------
+    Parameters:
+        labels: [N], the labels of the samples
+        num_users: the number of users
+        num_shards: the number of shards
+        rng: the random generator
+    Returns:
+        the sample indices of each user
+    """
+    shard_size = len(labels)//num_shards
+    shards_per_user = num_shards//num_users
+    # the stable sort keeps the samples of a label in their original order
+    shards = np.argsort(labels, kind="stable")[
+        :num_shards*shard_size].reshape(num_shards, shard_size)
+    chosen = rng.permutation(num_shards)[
+        :shards_per_user*num_users].reshape(num_users, shards_per_user)
+    return list(shards[chosen].reshape(num_users, -1))
+
+
+def dirichlet_split(labels: ndarray, num_users: int, alpha: float, rng: np.random.Generator) -> list[ndarray]:
+    """
+    split every label among the users by the proportions drawn from Dir(alpha),
+    a smaller alpha gives a more skewed label distribution
+    ------
+    Parameters:
+        labels: [N], the labels of the samples
+        num_users: the number of users
+        alpha: the concentration of the Dirichlet distribution
+        rng: the random generator
+    Returns:
+        the sample indices of each user
+    """
+    classes = np.unique(labels)
+    order = rng.permutation(len(labels))
+    # group the shuffled samples by label
+    order = order[np.argsort(labels[order], kind="stable")]
+    counts = np.bincount(np.searchsorted(classes, labels), minlength=len(classes))
+    proportions = rng.dirichlet(np.full(num_users, alpha), size=len(classes))
+    # the number of samples of every (label, user) pair
+    bounds = np.floor(np.cumsum(proportions, axis=1) *
+                      counts[:, None]).astype(np.int64)
+    bounds[:, -1] = counts
+    sizes = np.diff(bounds, axis=1, prepend=0)
+    # the samples are laid out label by label and user by user, sort them by user
+    owners = np.repeat(np.tile(np.arange(num_users), len(classes)), sizes.reshape(-1))
+    by_user = np.argsort(owners, kind="stable")
+    users = np.split(order[by_user], np.cumsum(sizes.sum(axis=0))[:-1])
+    return [np.sort(user) for user in users]
+
+
+def split_indices(labels: ndarray, scheme: str, num_users: int, seed: int = None, num_shards: int = None, alpha: float = 0.5) -> list[ndarray]:
+    """
+    split the samples among the users
+    ------
+    Parameters:
+        labels: [N], the labels of the samples
+        scheme: only support iid, shard and dirichlet
+        num_users: the number of users
+        seed: the seed of the split, None means a random split
+        num_shards: the number of shards of the shard scheme
+        alpha: the concentration of the dirichlet scheme
+    Returns:
+        the sample indices of each user
+    """
+    rng = np.random.default_rng(seed)
+    if scheme == "iid":
+        return iid_split(len(labels), num_users, rng)
+    elif scheme == "shard":
+        return shard_split(labels, num_users, num_shards, rng)
+    elif scheme == "dirichlet":
+        return dirichlet_split(labels, num_users, alpha, rng)
+    else:
+        raise ValueError("only support iid, shard and dirichlet partition")
+
+
+def partition(name: str, labels: ndarray, scheme: str, num_users: int, seed: int = None, num_shards: int = None, alpha: float = 0.5, root: str = r'data') -> list[ndarray]:
+    """
+    split the samples among the users, the split is cached as .npy index arrays keyed by
+    (dataset, scheme, num_users, seed), the alpha of dirichlet is also part of the key
+    ------
+    Parameters:
+        name: the name of the dataset
+        labels: [N], the labels of the samples
+        scheme: only support iid, shard and dirichlet
+        num_users: the number of users
+        seed: the seed of the split, None means a random split which is not cached
+        num_shards: the number of shards of the shard scheme
+        alpha: the concentration of the dirichlet scheme
+        root: the root of the datasets
+    Returns:
+        the sample indices of each user
+    """
+    labels = np.asarray(labels)
+    if seed is None:
+        return split_indices(labels, scheme, num_users, None, num_shards, alpha)
+    key = f"{name}_{scheme}_{num_users}_{seed}" + \
+        (f"_{alpha}" if scheme == "dirichlet" else "")
+    folder = os.path.join(root, "cache", "partitions")
+    index_path = os.path.join(folder, f"{key}_indices.npy")
+    offset_path = os.path.join(folder, f"{key}_offsets.npy")
+    if os.path.exists(index_path) and os.path.exists(offset_path):
+        indices, offsets = np.load(index_path), np.load(offset_path)
+        # a cache of another version of the dataset is recomputed
+        if len(indices) == 0 or indices.max() < len(labels):
+            return np.split(indices, offsets[1:-1])
+    users = split_indices(labels, scheme, num_users, seed, num_shards, alpha)
+    # the users are concatenated, the user i owns indices[offsets[i]:offsets[i+1]]
+    offsets = np.cumsum([0]+[len(user) for user in users])
+    os.makedirs(folder, exist_ok=True)
+    # write to a temporary file of this process first so that a concurrent run never reads a partial cache
+    for path, array in ((index_path, np.concatenate(users).astype(np.int64)), (offset_path, offsets)):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    return users
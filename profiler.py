@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import torch as t
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError:
+    # the peak rss is not reported on windows
+    resource = None
+
+
+class RoundProfiler(object):
+    """
+    Time the phases of every training round. The timings are written to the tensorboard and
+    to a json lines file, one line per round. The selected rounds can also be traced by
+    torch.profiler, the traces can be opened in chrome://tracing.
+    """
+
+    def __init__(self, writer, log_dir: str, enabled: bool = False, trace_rounds: list = None, device: t.device = t.device("cpu")):
+        """
+        Parameters:
+        -------
+        writer: the tensorboard SummaryWriter
+        log_dir: the folder of profile.jsonl and the traces
+        enabled: whether the rounds are timed, the phases cost nothing if False
+        trace_rounds: the rounds traced by torch.profiler
+        device: the device of the models, the cuda kernels are synchronized at the end of every phase
+        """
+        self.writer = writer
+        self.log_dir = log_dir
+        self.enabled = enabled
+        self.trace_rounds = set(trace_rounds or [])
+        self.synchronize = enabled and device.type == "cuda"
+        self.file = open(os.path.join(log_dir, "profile.jsonl"),
+                         "a") if enabled else None
+        self.trace = None
+        self.timings = {}
+        self.clients = []
+
+    def begin(self, round: int):
+        """
+        start timing a round
+        """
+        if not self.enabled:
+            return
+        self.timings = {}
+        self.clients = []
+        if round in self.trace_rounds:
+            activities = [t.profiler.ProfilerActivity.CPU]
+            if self.synchronize:
+                activities.append(t.profiler.ProfilerActivity.CUDA)
+            self.trace = t.profiler.profile(
+                activities=activities, record_shapes=True)
+            self.trace.__enter__()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        time a phase of the round, the time of the phases with the same name is summed up
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        with t.profiler.record_function(name) if self.trace is not None else nullcontext():
+            yield
+            if self.synchronize:
+                t.cuda.synchronize()
+        self.timings[name] = self.timings.get(
+            name, 0.)+time.perf_counter()-start
+
+    @contextmanager
+    def client(self, id: int):
+        """
+        time the local training of a client, the clients are trained in the order of their ids
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        with t.profiler.record_function(f"client_{id}") if self.trace is not None else nullcontext():
+            yield
+            if self.synchronize:
+                t.cuda.synchronize()
+        self.clients.append(time.perf_counter()-start)
+
+    def end(self, round: int, samples: int):
+        """
+        finish the round and write its timings
+        ------
+        Parameters:
+            round: the index of the round
+            samples: the number of samples trained by all clients in this round
+        """
+        if not self.enabled:
+            return
+        total = time.perf_counter()-self.start
+        if self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace.export_chrome_trace(os.path.join(
+                self.log_dir, f"trace_round_{round}.json"))
+            self.trace = None
+        train_time = self.timings.get("local_update", 0.)
+        record = {"round": round,
+                  "total": total,
+                  "phases": self.timings,
+                  "clients": self.clients,
+                  "samples_per_sec": samples/train_time if train_time > 0 else None,
+                  "peak_rss_mb": _peak_rss(resource.RUSAGE_SELF) if resource is not None else None,
+                  "peak_rss_children_mb": _peak_rss(resource.RUSAGE_CHILDREN) if resource is not None else None}
+        for name, seconds in self.timings.items():
+            self.writer.add_scalar(f"profile/{name} (s)", seconds, round)
+        self.writer.add_scalar("profile/round (s)", total, round)
+        if record["samples_per_sec"] is not None:
+            self.writer.add_scalar(
+                "profile/samples_per_sec", record["samples_per_sec"], round)
+        if record["peak_rss_mb"] is not None:
+            self.writer.add_scalar(
+                "profile/peak_rss (MB)", record["peak_rss_mb"], round)
+        self.file.write(json.dumps(record)+"\n")
+        self.file.flush()
+
+    def close(self):
+        """
+        close the json lines file
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def _peak_rss(who) -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss/1024
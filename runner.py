@@ -0,0 +1,139 @@
+import time
+import contextlib
+import numpy as np
+import torch as t
+import torch.nn as nn
+from torch import Tensor
+from copy import deepcopy
+from utils import functional_call
+
+
+class ModelRunner(object):
+    """
+    The forward pass of the client models with the cpu execution options: the channels_last
+    memory format, the bf16 autocast and torch.compile. All clients share one runner, the
+    graph is compiled once on a template of the architecture and the parameters of a client
+    are passed to it as inputs, so a new client does not trigger a recompilation.
+    """
+
+    def __init__(self, net: nn.Module, channels_last: bool = False, autocast: str = "none", compile: bool = False):
+        """
+        Parameters:
+        -------
+        net: the model of the clients, the runner keeps a copy of it as the template
+        channels_last: store the parameters and the inputs of the convolutions in the NHWC format
+        autocast: only support none and bf16, run the forward and backward passes in bf16
+        compile: compile the forward pass with torch.compile
+        """
+        if autocast not in ("none", "bf16"):
+            raise ValueError("only support none and bf16 autocast")
+        self.channels_last = channels_last
+        self.autocast = autocast
+        self.compile = compile
+        self.template = None
+        self.compiled = None
+        if compile:
+            self.template = deepcopy(net)
+            self.prepare(self.template)
+            self.compiled = t.compile(self._forward)
+
+    @property
+    def enabled(self) -> bool:
+        """
+        whether any option is on, the plain forward pass is used otherwise
+        """
+        return self.channels_last or self.autocast != "none" or self.compile
+
+    def prepare(self, model: nn.Module):
+        """
+        convert the parameters of a model in place, the parameter objects are kept so that
+        the optimizer and the components of the client still refer to them
+        """
+        if self.channels_last:
+            model.to(memory_format=t.channels_last)
+
+    def _forward(self, params: dict, buffers: dict, X: Tensor):
+        return functional_call(self.template, params, buffers, (X,))
+
+    def forward(self, model: nn.Module, X: Tensor) -> Tensor:
+        """
+        the forward pass of a client model
+        ------
+        Parameters:
+            model: the model of the client
+            X: the inputs
+        Returns:
+            the outputs in fp32
+        """
+        if self.channels_last and X.dim() == 4:
+            X = X.contiguous(memory_format=t.channels_last)
+        context = t.autocast(X.device.type, dtype=t.bfloat16) if self.autocast == "bf16" \
+            else contextlib.nullcontext()
+        with context:
+            if self.compiled is not None:
+                # the training mode is part of the guards, so train and test use their own graph
+                self.template.train(model.training)
+                y_hat = self.compiled(dict(model.named_parameters()),
+                                      dict(model.named_buffers()), X)
+            else:
+                y_hat = model.forward(X)
+        return y_hat.float()
+
+
+def execution_report(runner: ModelRunner, net: nn.Module, loss_func: nn.Module, train_batch: tuple, test_batches: list, repeat: int = 5):
+    """
+    time a training step and evaluate the test batches with every enabled option alone and
+    with all of them together, relative to the fp32 eager execution
+    ------
+    Parameters:
+        runner: the runner of the clients, its options are reported
+        net: the model, every option uses its own copy
+        loss_func: the loss function
+        train_batch: the (X, y) of the timed training steps
+        test_batches: the (X, y) of the evaluation
+        repeat: the number of timed steps
+    Returns:
+        dict: option -> step_ms, speedup, test_loss, test_acc and acc_delta
+    """
+    options = {"fp32": {}}
+    if runner.channels_last:
+        options["channels_last"] = {"channels_last": True}
+    if runner.autocast != "none":
+        options[runner.autocast] = {"autocast": runner.autocast}
+    if runner.compile:
+        options["compile"] = {"compile": True}
+    if len(options) > 2:
+        options["all"] = {"channels_last": runner.channels_last,
+                          "autocast": runner.autocast, "compile": runner.compile}
+    report = {}
+    for option, kwargs in options.items():
+        model = deepcopy(net)
+        option_runner = ModelRunner(model, **kwargs)
+        option_runner.prepare(model)
+        X, y = train_batch
+
+        def step():
+            loss = loss_func(option_runner.forward(model, X), y)
+            model.zero_grad()
+            loss.backward()
+        # the warmup steps include the compilation
+        for _ in range(2):
+            step()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            step()
+        step_ms = (time.perf_counter()-start)/repeat*1000
+        losses, correct, total = [], 0, 0
+        with t.no_grad():
+            for X_test, y_test in test_batches:
+                y_hat = option_runner.forward(model, X_test)
+                losses.append(loss_func(y_hat, y_test).item())
+                correct += (y_hat.argmax(1) == y_test).sum().item()
+                total += len(y_test)
+        report[option] = {"step_ms": step_ms,
+                          "test_loss": float(np.mean(losses)),
+                          "test_acc": 100.*correct/total}
+    for option in report.values():
+        option["speedup"] = report["fp32"]["step_ms"]/option["step_ms"]
+        option["acc_delta"] = option["test_acc"]-report["fp32"]["test_acc"]
+    return report
@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import torch as t
+import utils
+from DLLSOA import DLLSOA, load_data
+from checkpoint import capture_state
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+# the settings which determine the dataset split, the initialization and the first
+# local update phase, the runs with the same values share them
+PREFIX_KEYS = ["dataset", "iid", "partition", "dirichlet_alpha", "num_clients", "batch_size", "lr", "ep_num", "seed",
+               "model_name", "cuda", "data_backend", "augment", "engine", "train_mode",
+               "vmap_chunk", "num_workers", "worker_threads", "channels_last", "autocast", "compile",
+               "execution"]
+
+# the runs of the process pool, they are inherited by the forked workers
+_RUNS = []
+
+
+def prefix_key(args: dict) -> tuple:
+    """
+    the key of the shared prefix of a run
+    ------
+    Parameters:
+        args: the configuration
+    Returns:
+        the values of PREFIX_KEYS, the missing ones are None
+    """
+    return tuple(str(args.get(key)) for key in PREFIX_KEYS)
+
+
+def config_hash(args: dict) -> str:
+    """
+    the hash of a configuration, the finished runs are skipped by it
+    """
+    text = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def expand_grid(args: dict) -> list:
+    """
+    expand a grid spec, the grid entry maps the keys to the lists of their values
+    and the other entries are shared by all runs
+    ------
+    Parameters:
+        args: the configuration, a plain configuration is a grid of one run
+    Returns:
+        the configurations of the cartesian product of the grid
+    """
+    grid = args.get("grid")
+    if grid is None:
+        return [args]
+    base = {key: value for key, value in args.items() if key != "grid"}
+    keys = list(grid.keys())
+    return [dict(base, **dict(zip(keys, values))) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def group_configs(configs: list) -> list:
+    """
+    group the configurations by their shared prefix, the order of the runs is kept
+    ------
+    Parameters:
+        configs: the configurations
+    Returns:
+        the list of the groups, every group is a list of configurations
+    """
+    groups = {}
+    for args in configs:
+        groups.setdefault(prefix_key(args), []).append(args)
+    return list(groups.values())
+
+
+def summary_path(args: dict) -> str:
+    # the summary of a finished run, it also marks the run as finished
+    return os.path.join(args["log_dir"], "sweep", config_hash(args), "summary.json")
+
+
+def compute_prefix(args: dict, data: tuple):
+    """
+    initialize the clients and run the first local update phase once for a group
+    ------
+    Parameters:
+        args: the configuration of any run of the group
+        data: the result of load_data
+    Returns:
+        the snapshot after the first local update phase and the train loss of the clients
+    """
+    args = dict(args, log_dir=os.path.join(
+        args["log_dir"], "sweep", "prefix-"+config_hash(args)))
+    prefix = DLLSOA(args, data)
+    # the reference copies of topk and randk start from the initial parameters
+    initial = t.stack([client.flat_params().cpu().clone()
+                      for client in prefix.clients])
+    prefix.start_pool()
+    losses = prefix.local_update()
+    state = capture_state(prefix, 0)
+    state["reference"] = initial
+    if prefix.pool is not None:
+        prefix.pool.close()
+    prefix.writer.close()
+    return state, losses
+
+
+def run(index: int) -> dict:
+    """
+    fork a run from its prefix and train it, the runs without a prefix start from scratch
+    ------
+    Parameters:
+        index: the index of the run in _RUNS
+    Returns:
+        the throughput summary of the run
+    """
+    args, data, state, losses = _RUNS[index]
+    path = summary_path(args)
+    # every run logs to its own folder, the runs may start in the same second
+    model = DLLSOA(dict(args, log_dir=os.path.dirname(path)), data)
+    if state is not None:
+        model.fork(state, list(losses))
+    begin = time.perf_counter()
+    model.train()
+    seconds = time.perf_counter()-begin
+    model.writer.close()
+    rounds = model.train_epoch-model.start_round
+    samples = rounds*model.clients[0].ep_num * \
+        sum(len(client.train_loader.dataset) for client in model.clients)
+    summary = {"hash": config_hash(args),
+               "seconds": seconds,
+               "rounds": rounds,
+               "rounds_per_sec": rounds/seconds,
+               "samples_per_sec": samples/seconds,
+               "config": args}
+    with open(path, "w") as f:
+        json.dump(summary, f, default=str)
+    return summary
+
+
+def _init_worker(num_threads: int):
+    # the cores are split between the runs
+    t.set_num_threads(num_threads)
+
+
+def run_sweep(configs: list, num_processes: int = None) -> list:
+    """
+    run the configurations in a pool of processes. The runs with the same prefix_key share
+    the dataset split, the initial models and the first local update phase, which are
+    computed once in the parent process and inherited by the forked workers. The runs whose
+    summary exists are skipped.
+    ------
+    Parameters:
+        configs: the configurations
+        num_processes: the number of the processes, default is the number of cores,
+            1 runs the configurations in this process
+    Returns:
+        the throughput summaries of the finished runs
+    """
+    _RUNS.clear()
+    for group in group_configs(configs):
+        group = [args for args in group if not os.path.exists(
+            summary_path(args))]
+        if len(group) == 0:
+            continue
+        # the decoded dataset is loaded once, the workers share its pages
+        data = load_data(group[0])
+        state, losses = None, None
+        # the asynchronous runs can not share a prefix, they only share the dataset
+        if group[0].get("execution", "sync") != "async":
+            state, losses = compute_prefix(group[0], data)
+        _RUNS.extend((args, data, state, losses) for args in group)
+    print(f"{len(configs)-len(_RUNS)} finished runs are skipped")
+    if num_processes is None:
+        num_processes = os.cpu_count()
+    num_processes = max(1, min(num_processes, len(_RUNS)))
+    if t.cuda.is_initialized():
+        # the forked processes can not use the cuda context of the parent
+        num_processes = 1
+    if any(args.get("compile", False) for args, _, _, _ in _RUNS):
+        # the compiled backward of the prefix starts the autograd threads, which can not be forked
+        num_processes = 1
+    if num_processes == 1:
+        summaries = [run(i) for i in range(len(_RUNS))]
+    else:
+        # the runs create their own worker pools, so the workers must not be daemons
+        with ProcessPoolExecutor(num_processes, mp.get_context("fork"), _init_worker,
+                                 (max(1, os.cpu_count()//num_processes),)) as executor:
+            summaries = list(executor.map(run, range(len(_RUNS))))
+    _RUNS.clear()
+    for summary in summaries:
+        print(f"{summary['hash']}: {summary['seconds']:.1f}s, {summary['rounds_per_sec']:.3f} rounds/s, "
+              f"{summary['samples_per_sec']:.1f} samples/s")
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="sweep_DLLSOA", description="run the DLLSOA config files with shared prefixes"
+    )
+    parser.add_argument(
+        "config_paths",
+        type=str,
+        nargs="+",
+        help="the config files, the grid specs or the folders of config files",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="the number of the runs in parallel, default is the number of cores, use 1 with cuda",
+        default=None,
+    )
+    config_arg = parser.parse_args()
+    paths = []
+    for path in config_arg.config_paths:
+        if os.path.isdir(path):
+            # 1.yaml, 2.yaml, ... are run in numerical order
+            files = [f for f in os.listdir(path) if f.endswith(".yaml")]
+            files.sort(key=lambda f: (len(f), f))
+            paths.extend(os.path.join(path, f) for f in files)
+        else:
+            paths.append(path)
+    configs = []
+    for path in paths:
+        configs.extend(expand_grid(utils.load_config(path)))
+    run_sweep(configs, config_arg.processes)
+
+
+if __name__ == "__main__":
+    main()
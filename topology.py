@@ -0,0 +1,395 @@
+import os
+import numpy as np
+from numpy import ndarray
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Graph(object):
+    """
+    An undirected graph of the clients stored in the CSR form, the neighbors of client i
+    are indices[indptr[i]:indptr[i+1]] in ascending order. The graph optionally carries the
+    weight of every edge and the self weight of every client, i.e. the weight matrix W
+    without its n^2 zeros.
+    """
+
+    def __init__(self, num_nodes: int, indptr: ndarray, indices: ndarray, weights: ndarray = None, self_weights: ndarray = None):
+        """
+        Parameters:
+        -------
+        num_nodes: the number of clients
+        indptr: [num_nodes+1], the row pointers
+        indices: [nnz], the neighbors of every client, sorted in every row
+        weights: [nnz], the W_ij of every edge
+        self_weights: [num_nodes], the W_ii of every client
+        """
+        self.num_nodes = num_nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.self_weights = self_weights
+
+    @classmethod
+    def from_edges(cls, num_nodes: int, rows: ndarray, cols: ndarray):
+        """
+        build a graph from a list of edges, the edges are symmetrized, the duplicated
+        edges and the self loops are removed
+        ------
+        Parameters:
+            num_nodes: the number of clients
+            rows: the first end of every edge
+            cols: the second end of every edge
+        Returns:
+            the graph without weights
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        # symmetrize and remove the self loops
+        keys = np.concatenate([rows*num_nodes+cols, cols*num_nodes+rows])
+        keys = np.unique(keys[np.tile(rows != cols, 2)])
+        rows, indices = np.divmod(keys, num_nodes)
+        indptr = np.zeros(num_nodes+1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+        return cls(num_nodes, indptr, indices)
+
+    @classmethod
+    def from_dense(cls, W: ndarray):
+        """
+        build a graph from a dense weight matrix, the non-zero off-diagonal entries are the edges
+        ------
+        Parameters:
+            W: [n, n], the weight matrix
+        Returns:
+            the graph whose weights are the entries of W
+        """
+        num_nodes = W.shape[0]
+        off_diagonal = W != 0.
+        np.fill_diagonal(off_diagonal, False)
+        rows, indices = np.nonzero(off_diagonal)
+        indptr = np.zeros(num_nodes+1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+        return cls(num_nodes, indptr, indices, W[rows, indices], np.diagonal(W).copy())
+
+    def degrees(self) -> ndarray:
+        """
+        the number of neighbors of every client
+        """
+        return np.diff(self.indptr)
+
+    def rows(self) -> ndarray:
+        """
+        the first end of every edge, i.e. the row index of every entry in indices
+        """
+        return np.repeat(np.arange(self.num_nodes), self.degrees())
+
+    def neighbors(self, i: int):
+        """
+        get the neighbors of client i
+        ------
+        Parameters:
+            i: the id of the client
+        Returns:
+            the ids of the neighbors and the weights of the edges
+        """
+        start, end = self.indptr[i], self.indptr[i+1]
+        weights = None if self.weights is None else self.weights[start:end]
+        return self.indices[start:end], weights
+
+    def metropolis(self):
+        """
+        compute the Metropolis-Hastings weights, W_ij = 1/max(d_i, d_j) where the degree d counts
+        the self loop, and W_ii = 1 - sum_j W_ij, the same as utils.init_w
+        ------
+        Returns:
+            the same graph with weights
+        """
+        degrees = self.degrees()+1
+        rows = self.rows()
+        weights = 1./np.maximum(degrees[rows], degrees[self.indices])
+        self_weights = 1.0 - np.bincount(rows, weights, minlength=self.num_nodes)
+        return Graph(self.num_nodes, self.indptr, self.indices, weights, self_weights)
+
+    def weight_norms(self) -> ndarray:
+        """
+        the l2 norm of the off-diagonal weights of every client
+        """
+        return np.sqrt(np.bincount(self.rows(), self.weights**2, minlength=self.num_nodes))
+
+    def to_dense(self) -> ndarray:
+        """
+        convert the graph into the dense weight matrix
+        ------
+        Returns:
+            [n, n], the weight matrix, the adjacency matrix if the graph has no weights
+        """
+        W = np.zeros((self.num_nodes, self.num_nodes))
+        W[self.rows(), self.indices] = 1. if self.weights is None else self.weights
+        np.fill_diagonal(W, 1. if self.self_weights is None else self.self_weights)
+        return W
+
+
+def erdos_renyi(num_nodes: int, degree: float, rng: np.random.Generator):
+    """
+    generate an Erdos-Renyi graph, every pair is connected with probability degree/(n-1),
+    only the sampled edges are materialized
+    ------
+    Parameters:
+        num_nodes: the number of clients
+        degree: the expected degree of every client
+        rng: the random number generator
+    Returns:
+        the graph
+    """
+    num_pairs = num_nodes*(num_nodes-1)//2
+    prob = min(1., degree/max(num_nodes-1, 1))
+    num_edges = rng.binomial(num_pairs, prob)
+    # sample the linear indices of the upper triangle and convert them into (i, j)
+    k = rng.choice(num_pairs, size=num_edges, replace=False)
+    rows = num_nodes-2 - np.floor(
+        np.sqrt(-8*k+4*num_nodes*(num_nodes-1)-7)/2.-0.5).astype(np.int64)
+    cols = k+rows+1-num_pairs+(num_nodes-rows)*(num_nodes-rows-1)//2
+    return Graph.from_edges(num_nodes, rows, cols)
+
+
+def k_regular(num_nodes: int, degree: int, rng: np.random.Generator = None):
+    """
+    generate a k-regular graph, the clients are connected as a circulant graph and
+    then randomly relabeled, so it is a random but not a uniformly sampled regular graph
+    ------
+    Parameters:
+        num_nodes: the number of clients
+        degree: the degree of every client, num_nodes*degree should be even
+        rng: the random number generator, None means no relabeling
+    Returns:
+        the graph
+    """
+    if degree >= num_nodes or (num_nodes*degree) % 2 != 0:
+        raise ValueError(
+            "the degree should be less than num_nodes and num_nodes*degree should be even")
+    nodes = np.arange(num_nodes)
+    rows, cols = [], []
+    for offset in range(1, degree//2+1):
+        rows.append(nodes)
+        cols.append((nodes+offset) % num_nodes)
+    if degree % 2 == 1:
+        # connect the opposite clients
+        rows.append(nodes[:num_nodes//2])
+        cols.append(nodes[:num_nodes//2]+num_nodes//2)
+    rows = np.concatenate(rows) if rows else nodes[:0]
+    cols = np.concatenate(cols) if cols else nodes[:0]
+    if rng is not None:
+        labels = rng.permutation(num_nodes)
+        rows, cols = labels[rows], labels[cols]
+    return Graph.from_edges(num_nodes, rows, cols)
+
+
+def ring(num_nodes: int):
+    """
+    generate a ring, client i is connected to client i-1 and i+1
+    """
+    return k_regular(num_nodes, min(2, num_nodes-1))
+
+
+def geometric(num_nodes: int, radius: float, rng: np.random.Generator):
+    """
+    generate a random geometric graph, the clients are placed uniformly in the unit square
+    and connected if their distance is not greater than radius. The clients are sorted by
+    the x coordinate, so only the pairs inside a strip of width radius are compared.
+    ------
+    Parameters:
+        num_nodes: the number of clients
+        radius: the connection radius
+        rng: the random number generator
+    Returns:
+        the graph
+    """
+    points = rng.random((num_nodes, 2))
+    order = np.argsort(points[:, 0])
+    points = points[order]
+    # the candidates of client i are i+1, ..., end[i]-1
+    end = np.searchsorted(points[:, 0], points[:, 0]+radius, side="right")
+    counts = end-np.arange(num_nodes)-1
+    rows = np.repeat(np.arange(num_nodes), counts)
+    cols = rows+1+np.arange(counts.sum()) - \
+        np.repeat(np.cumsum(counts)-counts, counts)
+    keep = np.sum((points[rows]-points[cols])**2, axis=1) <= radius**2
+    return Graph.from_edges(num_nodes, order[rows[keep]], order[cols[keep]])
+
+
+def dense(num_nodes: int, rng: np.random.Generator):
+    """
+    generate the random graph of utils.gen_topo, every pair is connected with probability 0.5
+    ------
+    Parameters:
+        num_nodes: the number of clients
+        rng: the random number generator
+    Returns:
+        the graph
+    """
+    mat = rng.standard_normal((num_nodes, num_nodes)) > 0
+    rows, cols = np.nonzero(np.triu(mat, 1))
+    return Graph.from_edges(num_nodes, rows, cols)
+
+
+def generate_graph(topology: str, num_nodes: int, rng: np.random.Generator, degree: float = 4, radius: float = 0.1):
+    """
+    generate a graph with the Metropolis-Hastings weights
+    ------
+    Parameters:
+        topology: the type of the graph, only support dense, erdos-renyi, ring, k-regular and geometric
+        num_nodes: the number of clients
+        rng: the random number generator
+        degree: the (expected) degree of erdos-renyi and k-regular
+        radius: the connection radius of geometric
+    Returns:
+        the weighted graph
+    """
+    if topology == "dense":
+        graph = dense(num_nodes, rng)
+    elif topology == "erdos-renyi":
+        graph = erdos_renyi(num_nodes, degree, rng)
+    elif topology == "ring":
+        graph = ring(num_nodes)
+    elif topology == "k-regular":
+        graph = k_regular(num_nodes, int(degree), rng)
+    elif topology == "geometric":
+        graph = geometric(num_nodes, radius, rng)
+    else:
+        raise ValueError(
+            "only support dense, erdos-renyi, ring, k-regular and geometric")
+    return graph.metropolis()
+
+
+def save_graphs(path: str, graphs: list[Graph]):
+    """
+    save a sequence of weighted graphs into a .npz file
+    ------
+    Parameters:
+        path: the path of the .npz file
+        graphs: the graphs, they must have the same number of clients
+    """
+    nnz = np.array([0]+[len(graph.indices) for graph in graphs])
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    # write to a temporary file of this process first so that a concurrent run never reads a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f,
+                 offsets=np.cumsum(nnz),
+                 indptr=np.stack([graph.indptr for graph in graphs]),
+                 indices=np.concatenate([graph.indices for graph in graphs]),
+                 weights=np.concatenate([graph.weights for graph in graphs]),
+                 self_weights=np.stack([graph.self_weights for graph in graphs]))
+    os.replace(tmp_path, path)
+
+
+def load_graphs(path: str) -> list[Graph]:
+    """
+    load the sequence of weighted graphs saved by save_graphs
+    ------
+    Parameters:
+        path: the path of the .npz file
+    Returns:
+        the graphs
+    """
+    with np.load(path) as f:
+        offsets, indptr, indices, weights, self_weights = (
+            f["offsets"], f["indptr"], f["indices"], f["weights"], f["self_weights"])
+    num_nodes = indptr.shape[1]-1
+    return [Graph(num_nodes, indptr[r], indices[offsets[r]:offsets[r+1]],
+                  weights[offsets[r]:offsets[r+1]], self_weights[r])
+            for r in range(len(indptr))]
+
+
+class TopologySchedule(object):
+    """
+    The graph of every training round. The graph is static, resampled every k rounds,
+    or replayed from a .npz file. The graph of the next period is generated in a
+    background thread while the current round trains, and every graph is generated by
+    its own random number generator seeded with (seed, period), so the sequence does
+    not depend on the timing of the thread.
+    """
+
+    def __init__(self, topology: str, num_nodes: int, mode: str = "resample", every: int = 1, seed: int = 0,
+                 degree: float = 4, radius: float = 0.1, path: str = None, num_rounds: int = None):
+        """
+        Parameters:
+        -------
+        topology: the type of the graph, see generate_graph
+        num_nodes: the number of clients
+        mode: only support static, resample and replay
+        every: the graph is resampled (or the next graph is replayed) every k rounds
+        seed: the seed of the graphs
+        degree: the (expected) degree of erdos-renyi and k-regular
+        radius: the connection radius of geometric
+        path: the .npz file of the graphs, it is required by replay. For static and resample,
+            the graphs are generated once, saved to path and replayed by the later runs
+        num_rounds: the number of training rounds, the number of graphs saved to path
+        """
+        if mode not in ("static", "resample", "replay"):
+            raise ValueError("only support static, resample and replay")
+        if every < 1:
+            raise ValueError("every should be a positive integer")
+        self.topology = topology
+        self.num_nodes = num_nodes
+        self.mode = mode
+        self.every = every
+        self.seed = seed
+        self.degree = degree
+        self.radius = radius
+        self.graphs = None
+        self.executor = None
+        self.pending = {}
+        if mode == "replay" and (path is None or not os.path.exists(path)):
+            raise ValueError("the replay schedule requires an existing topo_file")
+        if path is not None and not os.path.exists(path):
+            num_periods = 1 if mode == "static" else -(-num_rounds//every)
+            save_graphs(path, [self._generate(period)
+                               for period in range(num_periods)])
+        if path is not None:
+            self.graphs = load_graphs(path)
+            if self.graphs[0].num_nodes != num_nodes:
+                raise ValueError(
+                    f"the graphs in {path} have {self.graphs[0].num_nodes} clients instead of {num_nodes}")
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _generate(self, period: int) -> Graph:
+        rng = np.random.default_rng([self.seed, period])
+        return generate_graph(self.topology, self.num_nodes, rng, self.degree, self.radius)
+
+    def _period(self, round: int) -> int:
+        return 0 if self.mode == "static" else round//self.every
+
+    def graph(self, round: int) -> Graph:
+        """
+        get the graph of the given round and start generating the graph of the next period
+        ------
+        Parameters:
+            round: the index of the training round
+        Returns:
+            the weighted graph
+        """
+        period = self._period(round)
+        if self.graphs is not None:
+            return self.graphs[period % len(self.graphs)]
+        if period not in self.pending:
+            self.pending[period] = self.executor.submit(
+                self._generate, period)
+        graph = self.pending[period].result()
+        # drop the former periods and prefetch the next one
+        self.pending = {p: future for p, future in self.pending.items()
+                        if p >= period}
+        if self.mode == "resample" and period+1 not in self.pending:
+            self.pending[period+1] = self.executor.submit(
+                self._generate, period+1)
+        return graph
+
+    def close(self):
+        """
+        stop the background thread
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        self.pending = {}
@@ -4,6 +4,15 @@ import torch as t
 import torch.nn as nn
 import numpy as np
 from numpy import ndarray
+from copy import deepcopy
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+try:
+    from torch.func import functional_call as _functional_call
+    _MERGE_BUFFERS = False
+except ImportError:
+    # torch<2.0, the parameters and the buffers are passed in one dict
+    from torch.nn.utils.stateless import functional_call as _functional_call
+    _MERGE_BUFFERS = True
 
 
 def load_config(file_path: str) -> dict:
@@ -86,6 +95,25 @@ def accuracy(y_hat: t.Tensor, y: t.Tensor) -> float:
     return float(sum(cmp.type(y.dtype)))/y_hat.shape[0]
 
 
+def calculate_norms(tensors: list[t.Tensor]) -> list[float]:
+    """
+    Calculate the 2nd-norm of each tensor with one batched call and one synchronization
+    ------
+    Parameters:
+        tensors: the given tensors
+    Returns:
+        list: the 2nd-norm of each tensor
+    """
+    if len(tensors) == 0:
+        return []
+    with t.no_grad():
+        if hasattr(t, "_foreach_norm"):
+            norms = t._foreach_norm(tensors)
+        else:
+            norms = [t.norm(tensor) for tensor in tensors]
+        return t.stack(norms).tolist()
+
+
 def calculate_weight_norm(net: nn.Module, component_keys: list[str] = None):
     """
     Calculate the 2nd-norm of the weight layer of the network, will used in the 
@@ -99,16 +127,20 @@ def calculate_weight_norm(net: nn.Module, component_keys: list[str] = None):
         return the 2nd-norm in order of the component_keys
     """
 
-    weight_norm = {}
-    with t.no_grad():
-        if component_keys is not None:
-            for name, param in net.named_parameters():
-                if name in component_keys:
-                    weight_norm[name] = t.norm(param).item()
-        else:
-            for name, param in net.named_parameters():
-                if "weight" in name or "bias" in name:
-                    weight_norm[name] = t.norm(param).item()
+    names = []
+    params = []
+    if component_keys is not None:
+        component_keys = set(component_keys)
+        for name, param in net.named_parameters():
+            if name in component_keys:
+                names.append(name)
+                params.append(param)
+    else:
+        for name, param in net.named_parameters():
+            if "weight" in name or "bias" in name:
+                names.append(name)
+                params.append(param)
+    weight_norm = dict(zip(names, calculate_norms(params)))
 
     if component_keys is None:
         weight_norm = sorted(weight_norm.items(),
@@ -126,29 +158,103 @@ def calculate_grad_norm(net: nn.Module):
     Returns:
         dict: the sortd weight norm dictionary
     """
-    grad_norm = {}
+    names = []
+    grads = []
     for name, param in net.named_parameters():
         if "weight" in name or "bias" in name:
-            grad_norm[name] = t.norm(param.grad).item()
+            names.append(name)
+            grads.append(param.grad)
+    grad_norm = dict(zip(names, calculate_norms(grads)))
 
     grad_norm = sorted(grad_norm.items(), key=lambda x: x[1], reverse=True)
     return grad_norm
 
 
-def get_weight_num(net: nn.Module):
+# the buffers which can be transmitted as components, i.e. the running statistics of BatchNorm
+BUFFER_COMPONENTS = ("running_mean", "running_var")
+
+
+def get_component_keys(net: nn.Module, include_buffers: bool = False) -> list[str]:
+    """
+    the registry of the components which can be transmitted, in the order of the state dict
+    ------
+    Parameters:
+        net: the given net
+        include_buffers: whether the running statistics of the BatchNorm layers are components
+    Returns:
+        list: the weights and biases of the layers, and the running statistics if include_buffers
+    """
+    parameters = set(name for name, _ in net.named_parameters())
+    keys = []
+    for name in net.state_dict().keys():
+        if name in parameters:
+            if "weight" in name or "bias" in name:
+                keys.append(name)
+        elif include_buffers and name.endswith(BUFFER_COMPONENTS):
+            keys.append(name)
+    return keys
+
+
+def get_weight_num(net: nn.Module, include_buffers: bool = False):
     """
     get the number of the weight layer
     ------
     Parameters:
         net: nn.Module, the given net
+        include_buffers: whether the running statistics of the BatchNorm layers are counted
     return:
         int, the number of weight layers
     """
-    num = 0
-    for name, _ in net.named_parameters():
-        if "weight" in name or "bias" in name:
-            num += 1
-    return num
+    return len(get_component_keys(net, include_buffers))
+
+
+def functional_call(net: nn.Module, params: dict, buffers: dict, args: tuple):
+    """
+    call the net with the given parameters and buffers instead of its own ones
+    ------
+    Parameters:
+        net: the template net
+        params: the name -> parameter dict
+        buffers: the name -> buffer dict
+        args: the inputs of the forward pass
+    Returns:
+        the outputs of the forward pass
+    """
+    if _MERGE_BUFFERS:
+        return _functional_call(net, {**params, **buffers}, args)
+    return _functional_call(net, (params, buffers), args)
+
+
+def fold_conv_bn(net: nn.Module) -> nn.Module:
+    """
+    fold every BatchNorm2d into the Conv2d right before it in a nn.Sequential, the folded
+    net uses the running statistics, i.e. it is the net in the eval mode
+    ------
+    Parameters:
+        net: the given net, it is not modified
+    Returns:
+        the folded copy of the net in the eval mode
+    """
+    with t.no_grad():
+        # the gradients are not needed by the inference
+        grads = {param: param.grad for param in net.parameters()}
+        for param in grads:
+            param.grad = None
+        try:
+            folded = deepcopy(net).eval()
+        finally:
+            for param, grad in grads.items():
+                param.grad = grad
+        for module in folded.modules():
+            if not isinstance(module, nn.Sequential):
+                continue
+            names = list(module._modules.keys())
+            for conv_name, bn_name in zip(names, names[1:]):
+                conv, bn = module._modules[conv_name], module._modules[bn_name]
+                if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                    module._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+                    module._modules[bn_name] = nn.Identity()
+    return folded
 
 
 def compute_power_coeff(E: float, W: float, channel_gain: ndarray, x: ndarray, pow_limit: bool, pow_allow_stg: str):
@@ -270,16 +376,15 @@ def init_w(adj_mat: ndarray,):
     Returns:
         the weight matrix of $\mathcal{R}^{n \times n}$ shape.
     """
-    P = np.zeros_like(adj_mat)
-    for i in range(adj_mat.shape[0]):
-        for j in range(adj_mat.shape[1]):
-            if i != j and adj_mat[i][j] != 0:
-                P[i][j] = 1./np.max(
-                    [np.sum(adj_mat[i]),
-                     np.sum(adj_mat[j]), ]
-                )
-        # in the end update P_{ij} when i=j
-        P[i][i] = 1.0 - np.sum(P[i])
+    # P_{ij} = 1/max(d_i, d_j) for every edge, computed with the degree vector at once
+    degree = np.sum(adj_mat, axis=1)
+    edge = adj_mat != 0
+    np.fill_diagonal(edge, False)
+    max_degree = np.maximum(degree[:, None], degree[None, :])
+    P = np.divide(1., max_degree, out=np.zeros_like(adj_mat, dtype=np.float64),
+                  where=edge)
+    # in the end update P_{ij} when i=j
+    np.fill_diagonal(P, 1.0 - np.sum(P, axis=1))
     return P
 
 